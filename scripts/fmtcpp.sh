@@ -11,8 +11,6 @@ fi
 
 . scripts/x/run_in_docker.sh
 
-# Note: we use stdin to pipe the file instead of letting clang
-# to read it because otherwise clang will user file's folder to search
-# for the style config file instead the current directory (which
-# by the way, we change to where the .clang-format file is)
-cat "$1" | ( cd scripts/x/ ; clang-format -style=file ) > "$2"
+# clang-format -style=file with scripts/x/.clang-format and a persistent
+# cache (see fmtcpp.py)
+./scripts/x/fmtcpp.py "$1" "$2"
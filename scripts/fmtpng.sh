@@ -11,4 +11,5 @@ fi
 
 . scripts/x/run_in_docker.sh
 
-optipng -o7 --strip all -quiet -out "$2" "$1"
+# optipng -o7 --strip all with a persistent cache (see fmtpng.py)
+./scripts/x/fmtpng.py "$1" "$2"
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+# Benchmarks of the j2 scripts:
+#
+#   render: rendering of parts/*.j2.md with j2 (as the !j2md rule of the
+#   Tupfile does) without the bytecode cache, with it cold (empty) and
+#   with it warm (see j2_common.py).
+#
+#   shape: shaping (strip, compact and indent) of the files included
+#   with include_block/include_file_raw by the original code and by
+#   shape_text (see j2-md.py), over out/t/src/* and a large synthetic
+#   source file, checking that both give the same text.
+#
+# Run it from the root of the project once Tup built out/ (some parts
+# include files from out/):
+#
+#   ./scripts/j2-bench.py [render [<rounds>] | shape]
+
+import os, re, sys, glob, time, shutil, random, tempfile, subprocess
+import importlib.machinery, importlib.util
+
+def render(part, cache_dir):
+    env = dict(os.environ)
+    env.pop('J2_BYTECODE_CACHE', None)
+    if cache_dir:
+        env['J2_BYTECODE_CACHE'] = cache_dir
+
+    begin = time.perf_counter()
+    subprocess.run(['j2', '--customize', 'scripts/j2-md.py', part],
+            env=env, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - begin
+
+def bench_render(rounds=3):
+    parts = sorted(glob.glob('parts/*.j2.md'))
+
+    totals = {'off': 0, 'cold': 0, 'warm': 0}
+    print('%-35s %8s %8s %8s' % ('part', 'off', 'cold', 'warm'))
+    for part in parts:
+        times = {'off': 0, 'cold': 0, 'warm': 0}
+        for _ in range(rounds):
+            cache_dir = tempfile.mkdtemp(prefix='j2-bench-')
+            try:
+                times['off'] += render(part, None)
+                times['cold'] += render(part, cache_dir)
+                times['warm'] += render(part, cache_dir)
+            finally:
+                shutil.rmtree(cache_dir)
+
+        print('%-35s %7.1fms %7.1fms %7.1fms' % ((part,) + tuple(
+            times[k] / rounds * 1000 for k in ('off', 'cold', 'warm'))))
+        for k in totals:
+            totals[k] += times[k] / rounds
+
+    print('%-35s %7.1fms %7.1fms %7.1fms' % (('total',) + tuple(
+        totals[k] * 1000 for k in ('off', 'cold', 'warm'))))
+
+def reference_shape(content, strip, indent, compact):
+    # include_block's shaping before shape_text
+    lines = content.split('\n')
+    if compact:
+        while lines and not lines[0].strip():
+            lines.pop(0)
+        while lines and not lines[-1].strip():
+            lines.pop()
+
+    if strip:
+        MAX = 9999999
+        min_indent = MAX
+        for l in lines:
+            space = re.match(r'^(\s*)\S', l)
+            if space:
+                space = space.group(1)
+                min_indent = min(min_indent, len(space))
+
+        if min_indent < MAX:
+            lines = (l[min_indent:] for l in lines)
+
+    if indent:
+        indent = ' ' * indent
+        lines = (indent + l for l in lines)
+
+    return '\n'.join(lines)
+
+def synthetic_source(nlines, seed=1):
+    ''' Return a C-like source of <nlines> lines, indented by at least
+        4 spaces, with long runs of empty lines at its begin and end. '''
+    rnd = random.Random(seed)
+    lines = [''] * (nlines // 10)
+    for i in range(nlines - len(lines) * 2):
+        if rnd.random() < .1:
+            lines.append(' ' * rnd.randint(0, 8))
+        else:
+            lines.append(' ' * (4 * rnd.randint(1, 4)) + 'x = foo(%d);  // bar' % i)
+    lines += ['    '] * (nlines // 10)
+    return '\n'.join(lines)
+
+def load_j2_md():
+    loader = importlib.machinery.SourceFileLoader('j2_md', 'scripts/j2-md.py')
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+def bench_shape(rounds=3):
+    j2_md = load_j2_md()
+    shape_text = j2_md.shape_text.__wrapped__   # without the cache
+
+    sources = sorted(glob.glob('out/t/src/*'))
+    if not sources:
+        print('No files in out/t/src/, using src/ instead (run Tup first)')
+        sources = sorted(glob.glob('src/*'))
+
+    texts = []
+    for fname in sources:
+        with open(fname, 'rt', encoding='utf-8') as f:
+            texts.append((fname, f.read()))
+    texts.append(('synthetic (200000 lines)', synthetic_source(200000)))
+    texts.append(('only empty lines', '\n\n  \n'))
+
+    options = [(True, 0, True), (True, 4, True), (False, 4, False), (False, 0, True)]
+    print('%-35s %10s %10s %10s' % ('file', 'before', 'after', 'cached'))
+    for fname, text in texts:
+        for opts in options:
+            assert shape_text(text, *opts) == reference_shape(text, *opts), (fname, opts)
+
+        def timeit(fn):
+            begin = time.perf_counter()
+            for _ in range(rounds):
+                for opts in options:
+                    fn(text, *opts)
+            return (time.perf_counter() - begin) / rounds / len(options)
+
+        j2_md.shape_text.cache_clear()
+        j2_md.shape_text(text, *options[0])
+        times = (timeit(reference_shape), timeit(shape_text),
+                 timeit(lambda *args: j2_md.shape_text(*args)))
+        print('%-35s %8.3fms %8.3fms %8.3fms' % ((fname,) + tuple(t * 1000 for t in times)))
+
+BENCHMARKS = {
+    'render': bench_render,
+    'shape': bench_shape,
+    }
+
+def main(args=sys.argv):
+    name = args[1] if len(args) > 1 else 'render'
+    if name not in BENCHMARKS:
+        print('Unknown benchmark %s, expected one of: %s' % (
+            name, ', '.join(BENCHMARKS)), file=sys.stderr)
+        return 2
+
+    rounds = int(args[2]) if len(args) > 2 else 3
+    BENCHMARKS[name](rounds)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
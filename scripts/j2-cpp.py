@@ -4,31 +4,25 @@
 
 import jinja2
 
+# Shared code and startup profiling (see j2_common.py)
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import j2_common
+j2_common.mark('customize')
+
 # DO NOT RENAME THIS FUNCTION (required by j2cli)
 def j2_environment_params():
     # Jinja2 Environment configuration hook
     # http://jinja.pocoo.org/docs/2.10/api/#jinja2.Environment
-    return dict(
-        # Change the blocks' start/end markers
-        # from  {% xxx %}  to  /*% xxx %*/
-        # In this way, they look like C/C++ comments
-        block_start_string='/*%',
-        block_end_string='%*/',
-
-        # Change the variables' start/end markers
-        # from  {{ xxx }}  to  /*{ xxx }*/
-        variable_start_string='/*{',
-        variable_end_string='}/*',
-
-	# Change the comments' start/end/markers
-        # from  {# xxx #}  to  /*# xxx #*/
-	comment_start_string='/*#',
-	comment_end_string='#*/',
+    # The delimiters are shared with j2-md.py, see j2_common.py
+    return dict(j2_common.CPP_DELIMITERS,
+        # Opt-in, see j2_common.py
+        bytecode_cache=j2_common.bytecode_cache('cpp'),
         )
 
 # DO NOT RENAME THIS FUNCTION (required by j2cli)
 def j2_environment(env):
-    pass
+    j2_common.mark('environment')
 
 # DO NOT RENAME THIS FUNCTION (required by j2cli)
 def extra_tests():
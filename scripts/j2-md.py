@@ -2,8 +2,14 @@
 # See https://github.com/kolypto/j2cli
 # pip install j2cli
 
-import jinja2, re, os
-from functools import partial
+import jinja2, os
+from functools import partial, lru_cache
+
+# Shared code and startup profiling (see j2_common.py)
+import sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import j2_common
+j2_common.mark('customize')
 
 @jinja2.contextfunction
 def include_file_raw(ctx, name, indent=0):
@@ -23,16 +29,74 @@ def include_file_raw(ctx, name, indent=0):
         Example:
 
             {{ include_file_raw(src_dir + "/" + fname) }}
+
+        When the template is rendered by j2-stream.py, the file is not
+        read here but copied by chunks when its turn to be written
+        comes (see j2_common.py). In that case the result must go to
+        the output as it is: filters like trim would not see the
+        content of the file.
     '''
+    j2_common.record_dependency(name)
+    if j2_common.streaming():
+        # Check that the file exists now, so a wrong name still fails
+        # at the same point
+        if not os.path.isfile(name):
+            raise jinja2.TemplateNotFound(name)
+        return jinja2.Markup(j2_common.raw_file_marker(name, ' ' * indent))
+
     env = ctx.environment
     content = env.loader.get_source(env, name)[0]
 
     if indent:
-        # Note: Python's textwrap.indent is too smart for this
-        indent = ' ' * indent
-        content = '\n'.join(indent + line for line in content.split('\n'))
+        content = shape_text(content, indent=indent)
     return jinja2.Markup(content)
 
+@lru_cache(maxsize=256)
+def shape_text(content, strip=False, indent=0, compact=False):
+    ''' Shape the text <content> for include_block and include_file_raw.
+
+        If <compact> is given, the first and last lines that are empty
+        (or only have spaces) are removed.
+
+        If <strip> is given, the indentation common to all the non-empty
+        lines is removed from all of them.
+
+        If <indent> is given, that amount of spaces is added on the left
+        of all the lines, even if they are empty.
+
+        The results are cached: the same text is included several
+        times with the same options (like the same block of a file).
+    '''
+    lines = content.split('\n')
+
+    if compact:
+        begin, end = 0, len(lines)
+        while begin < end and not lines[begin].strip():
+            begin += 1
+        while end > begin and not lines[end-1].strip():
+            end -= 1
+        if begin == end:
+            return ''
+        if begin or end < len(lines):
+            lines = lines[begin:end]
+
+    if strip:
+        # the lines with only spaces do not count
+        min_indent = min((len(l) - len(l.lstrip()) for l in lines if l.strip()),
+                default=0)
+        if min_indent:
+            lines = [l[min_indent:] for l in lines]
+
+    # Note: Python's textwrap.indent is too smart for this
+    sep = '\n'
+    if indent:
+        sep += ' ' * indent
+
+    content = sep.join(lines)
+    if indent:
+        content = sep[1:] + content
+    return content
+
 
 def as_markup_latex(tex, block=True):
     if block:
@@ -130,8 +194,6 @@ def strip_fenced_code_block_markers(src):
     # ensamble the source again
     return '\n'.join(lines[1:-1])
 
-import dot2tex
-
 @jinja2.contextfunction
 def _diagrams__graphviz(ctx, src, **kargs):
     ''' Take a dot graph and recoded as a tikz graph.
@@ -157,12 +219,98 @@ def _diagrams__graphviz(ctx, src, **kargs):
     # a full Tex document.
     if not kargs.get('codeonly', False):
         kargs['figonly'] = True
-    tex = dot2tex.dot2tex(src, **kargs)
+
+    # dot2tex is heavy and only a few parts have diagrams: load it
+    # only when it is needed
+    dot2tex = j2_common.lazy_import('dot2tex')
+
+    # The layout of the graph by Graphviz is slow, reuse the Tikz code
+    # generated before for the same graph and arguments, if any
+    # (opt-in, see j2_common.disk_cache)
+    cache = j2_common.disk_cache('dot2tex')
+    if cache is None:
+        tex = dot2tex.dot2tex(src, **kargs)
+    else:
+        key = cache.key(src, kargs, getattr(dot2tex, '__version__', ''))
+        tex = cache.get(key)
+        if tex is None:
+            tex = dot2tex.dot2tex(src, **kargs)
+            cache.put(key, tex)
+
     return as_markup_latex(tex)
 
+# Index of the images' folders: for each folder, the files in it
+# grouped by their name without the extension. Each folder is listed
+# once, the first time that an image in it is looked up, and the
+# listing is reused by emoji() and fig() for the rest of the process
+# instead of probing the filesystem for each image.
+_image_folders = {}
+
+# Extensions that find_image() tries if the name of the image has none,
+# in the order of \DeclareGraphicsExtensions in graphicx's xetex.def
+# so the file picked is the one that xelatex will include ('' is for
+# a file without extension)
+IMAGE_EXTENSIONS = ('.pdf', '.eps', '.ps', '.png', '.jpg', '.jpeg', '.bmp', '')
+
+def _image_folder(folder):
+    folder = os.path.normpath(folder)
+    index = _image_folders.get(folder)
+    if index is None:
+        index = {}
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.is_file():
+                        stem, ext = os.path.splitext(entry.name)
+                        index.setdefault(stem, {})[ext] = entry.name
+        except FileNotFoundError:
+            pass
+        _image_folders[folder] = index
+
+    return index
+
+def find_image(path, what='Image', lenient=False):
+    ''' Return the path of the image file <path>.
+
+        If <path> has no extension, the ones in IMAGE_EXTENSIONS are
+        tried and the path of the only file found is returned.
+
+        If the image does not exist or if there are multiple files that
+        correspond to it (but with different extensions), an error is
+        raised so it is caught here and not later by xelatex.
+
+        If <lenient> is true, multiple files are not an error: the first
+        one in the order of IMAGE_EXTENSIONS, the one that xelatex would
+        include, is returned.
+    '''
+    folder, name = os.path.split(path)
+    stem, ext = os.path.splitext(name)
+    candidates = _image_folder(folder).get(stem, {})
+
+    if ext:
+        if ext not in candidates:
+            raise Exception(f"{what} path does not exist: '{path}'")
+        j2_common.record_dependency(path)
+        return path
+
+    found = [candidates[ext] for ext in IMAGE_EXTENSIONS if ext in candidates]
+    if not found:
+        raise Exception(f"{what} path does not exist: '{path}'")
+    if len(found) > 1 and not lenient:
+        raise Exception(f"{what} path is ambiguous. Is '{os.path.join(folder, found[1])}' or '{os.path.join(folder, found[0])}'?")
+
+    path = os.path.join(folder, found[0])
+    j2_common.record_dependency(path)
+    return path
+
 @jinja2.contextfunction
 def _figures__fig(ctx, path, position='here', caption='', captionpos='bottom',
         label=None, figparams={}, wrapsize=r'0.25\textwidth'):
+    # Fail early if the image does not exist; the path is kept as it is
+    # because xelatex resolves it in the same way, even if there are
+    # multiple files for it (hence lenient)
+    find_image(path, 'Figure', lenient=True)
+
     # Build the "include the figure" tex code
     figparams_str = ','.join(f'{key}={val}' for key, val in figparams.items())
     fig_include_tex = r'\includegraphics[%s]{%s}' % (figparams_str, path)
@@ -272,6 +420,41 @@ def _boxes__extra_footage_end(ctx):
     return as_markup_latex(r'''\end{tcolorbox}''')
 
 
+# The environments for C/C++ files (one per loader) and the templates
+# already compiled with them, by path and modification time.
+# See get_cpp_template
+_cpp_environments = {}
+_cpp_templates = {}
+
+def get_cpp_template(loader, name):
+    ''' Return the C/C++ file <name> as a Jinja template.
+
+        The file is compiled once and reused by the next calls unless
+        it is modified. This is needed because j2cli's loader never
+        considers a template up to date so Jinja would compile the file
+        again on each get_template.
+    '''
+    # This special environment is for processing C/C++ files
+    # because we cannot use the Environment for Mardown files
+    env = _cpp_environments.get(loader)
+    if env is None:
+        env = jinja2.Environment(loader=loader,
+                bytecode_cache=j2_common.bytecode_cache('cpp'),
+                **j2_common.CPP_DELIMITERS)
+        _cpp_environments[loader] = env
+
+    try:
+        key = (loader, os.path.abspath(name), os.stat(name).st_mtime_ns)
+    except OSError:
+        # let Jinja to report the error
+        return env.get_template(name)
+
+    template = _cpp_templates.get(key)
+    if template is None:
+        template = env.get_template(name)
+        _cpp_templates[key] = template
+    return template
+
 @jinja2.contextfunction
 def include_block(ctx, name, block, strip=True, indent=0, compact=True, ctx_env={}):
     ''' Function to open and read the given file (<name>), see it
@@ -294,30 +477,8 @@ def include_block(ctx, name, block, strip=True, indent=0, compact=True, ctx_env=
 
             {{ include_block(src_dir + "/" + fname, "header") }}
     '''
-    # This special environment is for processing C/C++ files
-    # because we cannot use the Environment for Mardown files
-    env = jinja2.Environment(
-        # Change the blocks' start/end markers
-        # from  {% xxx %}  to  /*% xxx %*/
-        # In this way, they look like C/C++ comments
-        block_start_string='/*%',
-        block_end_string='%*/',
-
-        # Change the variables' start/end markers
-        # from  {{ xxx }}  to  /*{ xxx }*/
-        variable_start_string='/*{',
-        variable_end_string='}/*',
-
-	# Change the comments' start/end/markers
-        # from  {# xxx #}  to  /*# xxx #*/
-	comment_start_string='/*#',
-	comment_end_string='#*/',
-
-        loader=ctx.environment.loader
-    )
-
-    # Get the template
-    template = env.get_template(name)
+    # Get the template (compiled once per file)
+    template = get_cpp_template(ctx.environment.loader, name)
 
     if block == None:
         content = template.render(ctx)
@@ -328,35 +489,7 @@ def include_block(ctx, name, block, strip=True, indent=0, compact=True, ctx_env=
         content = jinja2.utils.concat(block(ctx))
 
     if strip or indent or compact:
-        lines = content.split('\n')
-
-        if compact:
-            # drop the first lines if they are empty
-            while lines and not lines[0].strip():
-                lines.pop(0)
-
-            # drop the last lines if they are empty
-            while lines and not lines[-1].strip():
-                lines.pop()
-
-        if strip:
-            # Find the minimum of indentation to strip
-            MAX = 9999999
-            min_indent = MAX
-            for l in lines:
-                space = re.match(r'^(\s*)\S', l)
-                if space:
-                    space = space.group(1)
-                    min_indent = min(min_indent, len(space))
-
-            if min_indent < MAX:
-                lines = (l[min_indent:] for l in lines)
-
-        if indent:
-            indent = ' ' * indent
-            lines = (indent + l for l in lines)
-
-        content = '\n'.join(lines)
+        content = shape_text(content, strip, indent, compact)
 
     return jinja2.Markup(content)
 
@@ -385,18 +518,7 @@ def emoji(ctx, name, path='z/img/emoji'):
 
             {{ emoji('rocket.png', 'z/img/icons/') }}
     '''
-    path = os.path.join(path, name)
-    _, ext = os.path.splitext(path)
-    if not ext:
-        base = path
-        path = None
-        for ext in ('.pdf', '.png', '.jpeg', ''):
-            if os.path.exists(base + ext):
-                if path is not None:
-                    raise Exception(f"Emoji path is ambiguous. Is '{base + ext}' or '{path}'?")
-                path = base + ext
-    if not os.path.exists(path):
-        raise Exception(f"Emoji path does not exist: '{path}'")
+    path = find_image(os.path.join(path, name), 'Emoji')
 
     tex = r'\text{\raisebox{-0.2em}{\includegraphics[height=1em]{%s}}}' % path
     return as_markup_latex(tex, block=False)
@@ -406,10 +528,16 @@ def emoji(ctx, name, path='z/img/emoji'):
 def j2_environment_params():
     # Jinja2 Environment configuration hook
     # http://jinja.pocoo.org/docs/2.10/api/#jinja2.Environment
-    return dict()
+    return dict(
+        # Opt-in, see j2_common.py
+        bytecode_cache=j2_common.bytecode_cache('md'),
+        )
 
 # DO NOT RENAME THIS FUNCTION (required by j2cli)
 def j2_environment(env):
+    # Record the templates loaded (opt-in, see j2_common.py)
+    env.loader = j2_common.recording_loader(env.loader)
+
     # Public functions
     env.globals['include_file_raw'] = include_file_raw
     env.globals['ej'] = exercise_marker
@@ -434,6 +562,8 @@ def j2_environment(env):
     # Not used
     #env.globals['_ex__projects'] = _ex__projects
 
+    j2_common.mark('environment')
+
 # DO NOT RENAME THIS FUNCTION (required by j2cli)
 def extra_tests():
     """ Declare some custom tests
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# Streaming version of j2 (j2cli) for the templates that assemble large
+# outputs like main/textbook-main.j2.md: the output is written while
+# Jinja generates it (Template.generate()) instead of rendering it
+# into a string first, and the files included with include_file_raw
+# are copied by chunks (see j2_common.py).
+#
+# In this way the memory used is bounded by the largest chunk and not
+# by the size of the whole book.
+#
+# It takes the same arguments that the Tupfile passes to j2:
+#
+#   ./scripts/j2-stream.py --customize scripts/j2-md.py <template> [<data>] [-o <outfile>]
+
+import io, os, sys, argparse
+import importlib.machinery, importlib.util
+
+from j2cli.cli import Jinja2TemplateRenderer
+from j2cli.context import read_context_data
+from j2cli.extras import filters
+from j2cli.extras.customize import CustomizationModule
+
+import j2_common
+
+def load_customize(fname):
+    # like j2cli does, with the same module name
+    loader = importlib.machinery.SourceFileLoader('customize-module', fname)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+def stream(template, context, out):
+    ''' Render the <template> into the <out> stream replacing the
+        markers of the raw files by their content. '''
+    for chunk in template.generate(context):
+        if '\0' not in chunk:
+            out.write(chunk)
+            continue
+
+        # the parts at odd positions are the numbers of the markers
+        parts = j2_common.RAW_FILE_MARKER_RE.split(chunk)
+        for i, part in enumerate(parts):
+            if i % 2:
+                j2_common.copy_raw_file(int(part), out)
+            else:
+                out.write(part)
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog='j2-stream',
+            description='Render a Jinja2 template like j2 but streaming the output.')
+    parser.add_argument('--customize', default=None, metavar='python-file.py')
+    parser.add_argument('--undefined', action='store_true')
+    parser.add_argument('-o', metavar='outfile', dest='output_file')
+    parser.add_argument('template')
+    parser.add_argument('data', nargs='?', default=None)
+    args = parser.parse_args(argv)
+
+    j2_common.start_streaming()
+
+    customize = CustomizationModule(
+            load_customize(args.customize) if args.customize else None)
+
+    if args.data is None:
+        context = read_context_data('env', None, os.environ)
+    else:
+        fmt = {'.json': 'json', '.yml': 'yaml', '.yaml': 'yaml',
+               '.ini': 'ini', '.env': 'env'}[os.path.splitext(args.data)[1]]
+        with open(args.data) as f:
+            context = read_context_data(fmt, f, os.environ)
+
+    context = customize.alter_context(context)
+
+    renderer = Jinja2TemplateRenderer(os.getcwd(), args.undefined,
+            j2_env_params=customize.j2_environment_params())
+    customize.j2_environment(renderer._env)
+    renderer.register_filters({
+        'docker_link': filters.docker_link,
+        'env': filters.env,
+        })
+    renderer.register_filters(customize.extra_filters())
+    renderer.register_tests(customize.extra_tests())
+
+    template = renderer._env.get_template(args.template)
+
+    # j2 writes the output as UTF-8 bytes, without translating newlines
+    if args.output_file:
+        out = io.open(args.output_file, 'wt', encoding='utf-8', newline='')
+    else:
+        out = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', newline='')
+
+    with out:
+        stream(template, context, out)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
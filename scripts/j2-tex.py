@@ -4,6 +4,12 @@
 
 import jinja2
 
+# Shared code and startup profiling (see j2_common.py)
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import j2_common
+j2_common.mark('customize')
+
 @jinja2.contextfunction
 def include_file_raw(ctx, name):
     ''' Function to open and read the given file (<name>) and
@@ -38,7 +44,10 @@ def j2_environment_params():
         # from  {# xxx #}  to  ~# xxx #~
         # (required to not enter in conflict with Tex syntax)
 	comment_start_string='~#',
-	comment_end_string='#~'
+	comment_end_string='#~',
+
+        # Opt-in, see j2_common.py
+        bytecode_cache=j2_common.bytecode_cache('tex'),
     )
 
 # DO NOT RENAME THIS FUNCTION (required by j2cli)
@@ -48,6 +57,8 @@ def j2_environment(env):
     # (or ~{ include_file_raw(filename) }~ to be more precise)
     env.globals['include_file_raw'] = include_file_raw
 
+    j2_common.mark('environment')
+
 # DO NOT RENAME THIS FUNCTION (required by j2cli)
 def extra_tests():
     """ Declare some custom tests
@@ -0,0 +1,317 @@
+
+# Code shared by the j2cli customize scripts (j2-md.py, j2-cpp.py
+# and j2-tex.py) and by j2-stream.py
+#
+# The scripts are loaded by j2cli from their path, not as modules, so
+# they have to add this folder to sys.path before importing this:
+#
+#   sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+#   import j2_common
+
+import os, io, re, sys, time, json, atexit, importlib, hashlib
+import jinja2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'x'))
+import cache_util
+
+# Jinja delimiters for C/C++ files (used by j2-cpp.py for the files in
+# src/ and by j2-md.py's include_block to read blocks from them)
+CPP_DELIMITERS = dict(
+        # Change the blocks' start/end markers
+        # from  {% xxx %}  to  /*% xxx %*/
+        # In this way, they look like C/C++ comments
+        block_start_string='/*%',
+        block_end_string='%*/',
+
+        # Change the variables' start/end markers
+        # from  {{ xxx }}  to  /*{ xxx }*/
+        variable_start_string='/*{',
+        variable_end_string='}/*',
+
+        # Change the comments' start/end/markers
+        # from  {# xxx #}  to  /*# xxx #*/
+        comment_start_string='/*#',
+        comment_end_string='#*/',
+        )
+
+# Bytecode cache
+# ==============
+#
+# If J2_BYTECODE_CACHE is set to a folder (like out/cache/jinja), the
+# templates compiled by Jinja are saved there and reused by the next
+# j2 processes instead of compiling them again.
+#
+# Jinja invalidates an entry if the source of the template changes
+# (it keeps a hash of it) or if Python changes. The entries are also
+# kept in a folder per Jinja version and per kind of template because
+# the same file compiled with other delimiters is another template.
+#
+# The entries are written atomically (see scripts/x/cache_util.py) so
+# the j2 processes that Tup runs in parallel never read a partial one.
+class AtomicFileSystemBytecodeCache(jinja2.FileSystemBytecodeCache):
+    def dump_bytecode(self, bucket):
+        buf = io.BytesIO()
+        bucket.write_bytecode(buf)
+        cache_util.write_entry(self._get_cache_filename(bucket), buf.getvalue())
+
+_bytecode_caches = {}
+
+def bytecode_cache(kind):
+    ''' Return the bytecode cache for the templates of the given kind
+        ('md', 'cpp' or 'tex', one per set of delimiters) or None if
+        J2_BYTECODE_CACHE is not set.
+    '''
+    root = os.getenv("J2_BYTECODE_CACHE")
+    if not root:
+        return None
+
+    if kind not in _bytecode_caches:
+        directory = os.path.join(root, jinja2.__version__, kind)
+        os.makedirs(directory, exist_ok=True)
+        _bytecode_caches[kind] = AtomicFileSystemBytecodeCache(directory)
+
+    return _bytecode_caches[kind]
+
+# Streaming of raw files
+# ======================
+#
+# j2cli renders the whole template into a string before writing it;
+# j2-stream.py writes the output while Jinja generates it instead.
+#
+# To not load the files included raw (see include_file_raw in j2-md.py)
+# in memory either, in streaming mode they are registered here and
+# replaced in the output by a marker. When the marker reaches the output
+# stream, the file is copied there by chunks (see copy_raw_file()).
+RAW_FILE_CHUNK_SIZE = 1 << 16
+
+_raw_files = None
+
+def streaming():
+    ''' Return True if the template is being rendered by j2-stream.py '''
+    return _raw_files is not None
+
+def start_streaming():
+    global _raw_files
+    _raw_files = []
+
+def raw_file_marker(name, indent=''):
+    ''' Register the file <name> to be copied, each line indented by
+        <indent>, and return the marker that stands for it. '''
+    _raw_files.append((name, indent))
+    return '\0raw-file:%d\0' % (len(_raw_files) - 1)
+
+RAW_FILE_MARKER_RE = re.compile('\0raw-file:(\\d+)\0')
+
+def copy_raw_file(n, out):
+    ''' Copy to <out> the file registered for the marker <n> '''
+    name, indent = _raw_files[n]
+    with open(name, 'rt', encoding='utf-8') as f:
+        out.write(indent)
+        while True:
+            chunk = f.read(RAW_FILE_CHUNK_SIZE)
+            if not chunk:
+                break
+            if indent:
+                chunk = chunk.replace('\n', '\n' + indent)
+            out.write(chunk)
+
+# Dependencies
+# ============
+#
+# If J2_DEPS_FILE is set, the files that the render touched (the
+# template, the templates imported or included by it, the files read by
+# include_block/include_file_raw and the images) are written there as a
+# JSON object at the exit of the process. See watch.py
+_deps_fname = os.getenv("J2_DEPS_FILE")
+_deps = set()
+
+def record_dependency(path):
+    ''' Record that the render depends on the file <path> '''
+    if _deps_fname:
+        _deps.add(os.path.relpath(path))
+
+class RecordingLoader(jinja2.BaseLoader):
+    ''' Loader that records the templates loaded by the wrapped
+        <loader> as dependencies (see record_dependency()) '''
+    def __init__(self, loader):
+        self.loader = loader
+
+    def get_source(self, environment, template):
+        try:
+            source, filename, uptodate = self.loader.get_source(environment, template)
+        except jinja2.TemplateNotFound:
+            # record it anyway: the render must be retried once it exists
+            record_dependency(template)
+            raise
+
+        record_dependency(filename or template)
+        return source, filename, uptodate
+
+def recording_loader(loader):
+    ''' Return the <loader> wrapped to record the dependencies if
+        J2_DEPS_FILE is set or the <loader> itself otherwise. '''
+    return RecordingLoader(loader) if _deps_fname else loader
+
+def _write_deps():
+    try:
+        with open(_deps_fname, 'wt') as f:
+            json.dump({'argv': sys.argv, 'deps': sorted(_deps)}, f)
+    except OSError as err:
+        print("Cannot write the dependencies: %s" % err, file=sys.stderr)
+
+if _deps_fname:
+    atexit.register(_write_deps)
+
+# Disk caches
+# ===========
+#
+# Content addressed caches of text shared by all the j2 processes, even
+# if they run in parallel. See disk_cache() and scripts/x/cache_util.py
+class DiskCache:
+    ''' Cache of texts in the folder <directory>, one file per entry
+        named after the hash of its key (see key()).
+
+        When the cache is closed (at the exit of the process), the
+        entries used least recently are evicted until the total size is
+        below <max_size> bytes.
+    '''
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        ''' Hash the given parts (anything that json can dump) '''
+        data = json.dumps(parts, sort_keys=True, default=repr)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        value = cache_util.read_entry(os.path.join(self.directory, key))
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        cache_util.write_entry(os.path.join(self.directory, key), value)
+
+    def close(self):
+        self.evicted += cache_util.evict(self.directory, self.max_size)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evicted': self.evicted}
+
+_disk_caches = {}
+
+def disk_cache(name):
+    ''' Return the disk cache <name> or None if it is not enabled.
+
+        The cache is enabled setting J2_<NAME>_CACHE to the folder where
+        to keep it (like out/cache/dot2tex) and its size is limited to
+        J2_<NAME>_CACHE_MAX_MB megabytes (64 by default).
+
+        The stats of the caches are added to the startup report.
+    '''
+    if name not in _disk_caches:
+        var = 'J2_%s_CACHE' % name.upper()
+        directory = os.getenv(var)
+        cache = None
+        if directory:
+            max_mb = int(os.getenv(var + '_MAX_MB', 64))
+            cache = DiskCache(directory, max_mb * 1024 * 1024)
+            atexit.register(cache.close)
+
+        _disk_caches[name] = cache
+
+    return _disk_caches[name]
+
+# Startup profiling
+# =================
+#
+# If J2_STARTUP_REPORT is set, a JSON line is appended to that file
+# at the exit of each j2 process with:
+#
+#   - when the customize script was loaded, when the Jinja environment
+#     was ready and when the process finished, all in seconds since
+#     the process started (see mark())
+#   - how much took each lazy import (see lazy_import())
+#   - the hits, misses and evictions of each disk cache (see disk_cache())
+#
+# For a breakdown of the imports done before the customize script is
+# loaded (j2cli, jinja2, ...), use PYTHONPROFILEIMPORTTIME=1 (aka -X importtime)
+_report_fname = os.getenv("J2_STARTUP_REPORT")
+_marks = {}
+_imports = {}
+
+# The marks are taken with the clock of the process' start time in
+# /proc (since boot, counting the time suspended). Linux only: elsewhere
+# the marks are relative to the first one (see _write_report())
+_CLOCK = getattr(time, 'CLOCK_BOOTTIME', None)
+
+def _now():
+    return time.clock_gettime(_CLOCK) if _CLOCK is not None else time.monotonic()
+
+def _process_start():
+    ''' Return the time (in _now() scale) when this process started or
+        None if it is unknown. Linux only. '''
+    if _CLOCK is None:
+        return None
+    try:
+        with open('/proc/self/stat', 'rt') as f:
+            # the command name (2nd field) may have spaces, skip it
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (OSError, IndexError):
+        return None
+
+    # in clock ticks since boot
+    return int(fields[19]) / os.sysconf('SC_CLK_TCK')
+
+_start = _process_start() if _report_fname else None
+
+def mark(name):
+    ''' Record that the process reached the point <name>. '''
+    if _report_fname:
+        _marks[name] = _now()
+
+def lazy_import(name):
+    ''' Import the module <name> on its first use instead of at the
+        load of the customize script, timing it.
+
+        Use it for heavy modules that only a few templates need.
+    '''
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+
+    begin = time.monotonic()
+    module = importlib.import_module(name)
+    _imports[name] = time.monotonic() - begin
+    return module
+
+def _write_report():
+    mark('exit')
+    start = _start if _start is not None else min(_marks.values())
+    report = {
+        'argv': sys.argv,
+        'pid': os.getpid(),
+        'marks': {name: t - start for name, t in _marks.items()},
+        'lazy_imports': _imports,
+        'caches': {name: cache.stats()
+                    for name, cache in _disk_caches.items() if cache},
+        'modules': len(sys.modules),
+        }
+    try:
+        with open(_report_fname, 'at') as f:
+            f.write(json.dumps(report) + '\n')
+    except OSError as err:
+        print("Cannot write the startup report: %s" % err, file=sys.stderr)
+
+if _report_fname:
+    atexit.register(_write_report)
@@ -18,6 +18,18 @@ rm -f "$2/$(basename -s .tex "$1").{snippets,pygmented}"
 # script which file look for pygment
 export PYGMENTE_TARGET="$2/$(basename -s .tex "$1")"
 
+# persistent cache of highlighted snippets shared between runs so only
+# the new or edited snippets are highlighted again (see pygmentex.py)
+#
+# By default each document has its own cache. Set PYGMENTEX_SHARED_CACHE=1
+# to share a single cache between all of them so the code blocks of the
+# parts are highlighted once and reused by the main book (and vice versa)
+if [ "$PYGMENTEX_SHARED_CACHE" = "1" ]; then
+    export PYGMENTEX_CACHE_DIR="${PYGMENTEX_CACHE_DIR-out/cache/pygmentex/shared}"
+else
+    export PYGMENTEX_CACHE_DIR="${PYGMENTEX_CACHE_DIR-out/cache/pygmentex/$(basename -s .tex "$1")}"
+fi
+
 
 #run_in_docker \
 latexmk \
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+# Report of the time and memory spent by each stage of the build, from
+# the log written by scripts/x/stage-time.py (out/stats/stages.jsonl).
+#
+# Rank the slowest stages and targets (parts, images, sources) of the
+# build:
+#
+#   ./scripts/stage-report.py [--top <n>]
+#
+# The log accumulates the commands run by each Tup invocation; when
+# a target was built several times, its last run is the one reported.
+# To compare two builds, save the log of the first one (this starts
+# a new log) and, after the second build, compare against it:
+#
+#   tup && ./scripts/stage-report.py --save before
+#   ... change something ...
+#   tup && ./scripts/stage-report.py --compare before
+
+import os, sys, json, argparse
+
+STATS_DIR = 'out/stats'
+LOG = os.path.join(STATS_DIR, 'stages.jsonl')
+
+def saved_path(name):
+    if os.path.sep in name or name.endswith('.jsonl'):
+        return name
+    return os.path.join(STATS_DIR, 'builds', name + '.jsonl')
+
+def load(fname):
+    ''' Return the last run of each target by (stage, target).
+
+        The commands timed inside them (like the xelatex runs inside
+        the pdf stage) are added up by (stage, target).
+    '''
+    records = {}
+    nested = []
+    with open(fname, 'rt') as f:
+        for line in f:
+            try:
+                r = json.loads(line)
+            except ValueError:
+                continue    # a line cut by an interrupted build
+            r['runs'] = 1
+            if r.get('parent_id'):
+                nested.append(r)
+            else:
+                records[(r['stage'], r['target'])] = r
+
+    # add up the nested runs of the runs kept, level by level
+    runs = set(r['id'] for r in records.values())
+    while nested:
+        kept = [r for r in nested if r['parent_id'] in runs]
+        if not kept:
+            break
+        for r in kept:
+            k = (r['stage'], r['target'])
+            if k in records and records[k]['parent_id'] == r['parent_id']:
+                s = records[k]
+                s['runs'] += 1
+                s['status'] = s['status'] or r['status']
+                s['wall'] += r['wall']
+                s['cpu'] += r['cpu']
+                s['maxrss_kb'] = max(s['maxrss_kb'], r['maxrss_kb'])
+            else:
+                records[k] = r
+
+        # next level: the ones nested inside these
+        runs = set(r['id'] for r in kept)
+        nested = [r for r in nested if r['id'] not in runs]
+
+    return records
+
+def by_stage(records):
+    stages = {}
+    for r in records.values():
+        s = stages.setdefault(r['stage'], {'parent': r['parent'], 'runs': 0,
+            'failed': 0, 'wall': 0.0, 'cpu': 0.0, 'maxrss_kb': 0})
+        s['runs'] += r['runs']
+        s['failed'] += r['status'] != 0
+        s['wall'] += r['wall']
+        s['cpu'] += r['cpu']
+        s['maxrss_kb'] = max(s['maxrss_kb'], r['maxrss_kb'])
+    return stages
+
+def stage_name(stage, parent):
+    return stage if not parent else '%s (in %s)' % (stage, parent)
+
+def report(records, top):
+    stages = by_stage(records)
+    total = sum(s['wall'] for s in stages.values() if not s['parent'])
+
+    print('Stages by wall time (total %.1fs, without the nested ones)' % total)
+    print('%-24s %5s %6s %10s %10s %10s' % ('stage', 'runs', 'failed', 'wall', 'cpu', 'peak RSS'))
+    for name, s in sorted(stages.items(), key=lambda kv: -kv[1]['wall']):
+        print('%-24s %5d %6d %9.1fs %9.1fs %8.1fMB' % (stage_name(name, s['parent']),
+            s['runs'], s['failed'], s['wall'], s['cpu'], s['maxrss_kb'] / 1024))
+
+    print()
+    print('Slowest %d targets' % top)
+    print('%-24s %-40s %10s %10s %10s' % ('stage', 'target', 'wall', 'cpu', 'peak RSS'))
+    for r in sorted(records.values(), key=lambda r: -r['wall'])[:top]:
+        print('%-24s %-40s %9.1fs %9.1fs %8.1fMB' % (stage_name(r['stage'], r['parent']),
+            r['target'], r['wall'], r['cpu'], r['maxrss_kb'] / 1024))
+
+def delta(before, after):
+    if not before:
+        return '%+9.1fs' % after
+    return '%+9.1fs %+6.0f%%' % (after - before, (after - before) / before * 100)
+
+def compare(old, new, top):
+    old_stages, new_stages = by_stage(old), by_stage(new)
+
+    print('Stages: wall time before and after')
+    print('%-24s %10s %10s %18s' % ('stage', 'before', 'after', 'delta'))
+    for name in sorted(old_stages.keys() | new_stages.keys(),
+            key=lambda n: -new_stages.get(n, old_stages.get(n))['wall']):
+        b = old_stages.get(name, {}).get('wall', 0.0)
+        a = new_stages.get(name, {}).get('wall', 0.0)
+        parent = (new_stages.get(name) or old_stages.get(name))['parent']
+        print('%-24s %9.1fs %9.1fs %18s' % (stage_name(name, parent), b, a, delta(b, a)))
+
+    print()
+    print('Targets with the largest changes (of the ones in both builds)')
+    print('%-24s %-40s %10s %10s %18s' % ('stage', 'target', 'before', 'after', 'delta'))
+    common = sorted(old.keys() & new.keys(),
+            key=lambda k: -abs(new[k]['wall'] - old[k]['wall']))
+    for k in common[:top]:
+        b, a = old[k]['wall'], new[k]['wall']
+        print('%-24s %-40s %9.1fs %9.1fs %18s' % (stage_name(k[0], new[k]['parent']),
+            k[1], b, a, delta(b, a)))
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog='stage-report',
+            description='Report the time and memory spent by each stage of the build.')
+    parser.add_argument('--log', default=LOG, help='log to report (default: %(default)s)')
+    parser.add_argument('--top', type=int, default=10, help='targets to show (default: 10)')
+    parser.add_argument('--save', metavar='NAME',
+            help='save the log as the build NAME and start a new one')
+    parser.add_argument('--compare', metavar='NAME',
+            help='compare the log against the build NAME (or a log file)')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.log):
+        print('There is no log %s: build with Tup first' % args.log, file=sys.stderr)
+        return 1
+
+    if args.save:
+        dst = saved_path(args.save)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        os.replace(args.log, dst)
+        print('Saved the build as %s' % dst)
+        return 0
+
+    records = load(args.log)
+    if args.compare:
+        compare(load(saved_path(args.compare)), records, args.top)
+    else:
+        report(records, args.top)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
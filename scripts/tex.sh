@@ -31,8 +31,24 @@ fi
 . scripts/x/run_in_docker.sh
 
 # This is the way that we have to communicate to Panflute's filter
-# which file must log
-export PANFLUTE_TRACE_FILENAME="dbg/$(basename -s .tex "$2").panflute-trace"
+# which file must log. Tracing is disabled unless PANFLUTE_TRACE=1
+# (see magic.py3's Trace)
+if [ "$PANFLUTE_TRACE" = "1" ]; then
+    export PANFLUTE_TRACE_FILENAME="dbg/$(basename -s .tex "$2").panflute-trace.jsonl"
+fi
+
+# The filter leaves the code to pygmentex (see pdf.sh) unless
+# MAGIC_HIGHLIGHT=1: then it highlights the code itself and latexmk
+# saves the xelatex pass that reads the highlighted snippets back
+# (see magic.py3)
+
+# If a warm filter server is running (see magic.py3 --serve) and
+# MAGIC_SOCKET points to its socket, use it through the thin shim
+# instead of starting and importing all the filter for each document
+FILTER=scripts/x/magic.py3
+if [ -n "$MAGIC_SOCKET" -a -S "$MAGIC_SOCKET" ]; then
+    FILTER=scripts/x/magic-shim.py3
+fi
 
 #run_in_docker \
 pandoc \
@@ -41,7 +57,7 @@ pandoc \
     --to=latex \
     --top-level-division=chapter \
     --number-sections \
-    -F scripts/x/magic.py3 \
+    -F "$FILTER" \
     --include-in-header=main/textbook-main-header.tex \
     --listings  \
     --citeproc  \
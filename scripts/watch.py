@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+# Watch the sources of the book and rebuild only what a change affects
+# instead of the whole book.
+#
+# The stages are the ones of the Tupfile, run with the same commands:
+#
+#   src/*.j2.{c,h,cpp}  -- fmtcpp -->  out/t/src/  -- j2cpp -->  out/src/
+#   z/img/**.png        -- fmtpng -->  out/z/img/
+#   parts/*.j2.md       -- j2md   -->  out/parts/md/  -- tex -->  out/parts/tex/  -- pdf --> out/parts/pdf/
+#
+# and, with --main, the assembly of the book (main/textbook-main.j2.md)
+# and its tex and pdf.
+#
+# The dependencies of the Jinja stages are not known in advance: the
+# templates, macros, include_block/include_file_raw sources and images
+# that each render touched are recorded by j2-md.py (see J2_DEPS_FILE
+# in j2_common.py) into out/cache/deps/. On start, the parts without
+# recorded dependencies are rendered once to know them, and their tex
+# and pdf are rebuilt from that render.
+#
+# The files that a stage reads besides its input but that cannot be
+# recorded (the data of the book's index, read by j2cli itself, and the
+# filter, header and bibliography used by pandoc and xelatex) are given
+# to the stage explicitly (see Stage's <extra>).
+#
+# When a file changes, the stages whose inputs depend on it are run and
+# their outputs are considered changed for the next stages. So editing
+# a paragraph of parts/gfx.j2.md rebuilds only gfx; editing
+# z/templ/figures.j2 rebuilds only the parts that use fig().
+#
+# The filesystem is watched with inotify (Linux) or polling the mtimes
+# of the files if inotify is not available.
+#
+# Run it from the root of the project, inside the container:
+#
+#   ./scripts/watch.py [--main] [--poll] [--interval <seconds>]
+#
+# Changes to the scripts themselves are not tracked (but magic.py3's):
+# restart it.
+
+import os, sys, glob, json, time, errno, select, struct, argparse, subprocess
+import ctypes, ctypes.util
+
+DEPS_DIR = 'out/cache/deps'
+
+# The folders of the sources (not the outputs: the changes in out/ are
+# made by the stages and propagated by them)
+WATCHED = ('parts', 'main', 'src', 'z')
+
+def j2(customize, src, dst, deps=None, data=None, script='j2'):
+    ''' Render <src> into <dst> as the !j2md/!j2cpp/!j2stream rules do,
+        recording its dependencies into <deps> if given. '''
+    env = dict(os.environ)
+    if deps:
+        env['J2_DEPS_FILE'] = deps
+    with open(dst, 'wb') as out:
+        return subprocess.run([script, '--customize', customize, src] +
+                ([data] if data else []), stdout=out, env=env).returncode
+
+class Stage:
+    ''' A rule of the Tupfile: the inputs are the files matched by the
+        <patterns>, each one produces the file returned by <output>,
+        running <command>(input, output, deps).
+
+        If <recorded> is True, the dependencies of each input are the
+        files that the command recorded in out/cache/deps/; otherwise
+        the input is the only dependency. In both cases, the files in
+        <extra> are dependencies of all the inputs.
+    '''
+    def __init__(self, name, patterns, output, command, recorded=False, extra=()):
+        self.name = name
+        self.patterns = patterns
+        self.output = output
+        self.command = command
+        self.recorded = recorded
+        self.extra = set(extra)
+
+    def inputs(self):
+        return sorted(set(f for p in self.patterns for f in glob.glob(p, recursive=True)))
+
+    def deps_file(self, src):
+        return os.path.join(DEPS_DIR, self.name, src.replace('/', '%') + '.json')
+
+    def dependencies(self, src):
+        ''' Return the dependencies of <src> or None if they were not
+            recorded yet '''
+        if not self.recorded:
+            return {src} | self.extra
+        try:
+            with open(self.deps_file(src), 'rt') as f:
+                return set(json.load(f)['deps']) | {src} | self.extra
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def run(self, src):
+        dst = self.output(src)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        deps = None
+        if self.recorded:
+            deps = self.deps_file(src)
+            os.makedirs(os.path.dirname(deps), exist_ok=True)
+
+        print('[%s] %s -> %s' % (self.name, src, dst), flush=True)
+        begin = time.monotonic()
+        status = self.command(src, dst, deps)
+        if status != 0:
+            print('[%s] %s failed (exit status %d)' % (self.name, src, status), flush=True)
+            return None
+
+        print('[%s] %s done in %.1fs' % (self.name, src, time.monotonic() - begin), flush=True)
+        return dst
+
+def name_of(path, ext):
+    return os.path.basename(path).split('.')[0] + ext
+
+# Read by tex.sh (pandoc) for every document
+TEX_EXTRA = ('scripts/x/magic.py3', 'main/textbook-main-header.tex', 'main/biblio.bib')
+
+# Read by biber for every document (see \addbibresource)
+PDF_EXTRA = ('main/biblio.bib',)
+
+def tex_stage(name, patterns, output):
+    return Stage(name, patterns, output,
+            lambda src, dst, deps: subprocess.run(['./scripts/tex.sh', src, dst]).returncode,
+            extra=TEX_EXTRA)
+
+def pdf_stage(name, patterns, outdir):
+    return Stage(name, patterns,
+            lambda src: os.path.join(outdir, name_of(src, '.pdf')),
+            lambda src, dst, deps: subprocess.run(['./scripts/pdf.sh', src, outdir + '/']).returncode,
+            extra=PDF_EXTRA)
+
+STAGES = [
+    Stage('fmtcpp', ['src/*.j2.c', 'src/*.j2.h', 'src/*.j2.cpp'],
+        lambda src: os.path.join('out/t/src', os.path.basename(src)),
+        lambda src, dst, deps: subprocess.run(['./scripts/fmtcpp.sh', src, dst]).returncode),
+    Stage('j2cpp', ['out/t/src/*.j2.c', 'out/t/src/*.j2.h', 'out/t/src/*.j2.cpp'],
+        lambda src: os.path.join('out/src', os.path.basename(src).replace('.j2.', '.')),
+        lambda src, dst, deps: j2('scripts/j2-cpp.py', src, dst)),
+    Stage('fmtpng', ['z/img/**/*.png'],
+        lambda src: os.path.join('out', src),
+        lambda src, dst, deps: subprocess.run(['./scripts/fmtpng.sh', src, dst]).returncode),
+
+    Stage('j2md', ['parts/*.j2.md'],
+        lambda src: os.path.join('out/parts/md', name_of(src, '.md')),
+        lambda src, dst, deps: j2('scripts/j2-md.py', src, dst, deps),
+        recorded=True),
+    tex_stage('tex', ['out/parts/md/*.md'],
+        lambda src: os.path.join('out/parts/tex', name_of(src, '.tex'))),
+    pdf_stage('pdf', ['out/parts/tex/*.tex'], 'out/parts/pdf'),
+    ]
+
+MAIN_STAGES = [
+    Stage('j2main', ['main/textbook-main.j2.md'],
+        lambda src: 'out/main/md/textbook-main.md',
+        lambda src, dst, deps: j2('scripts/j2-md.py', src, dst, deps,
+            data='main/index.yaml', script='./scripts/j2-stream.py'),
+        # j2cli reads the data itself, it is not seen by the loader
+        recorded=True, extra=['main/index.yaml']),
+    tex_stage('texmain', ['out/main/md/textbook-main.md'],
+        lambda src: 'out/main/tex/textbook-main.tex'),
+    pdf_stage('pdfmain', ['out/main/tex/textbook-main.tex'], 'out/main/pdf'),
+    ]
+
+def rebuild(stages, changed):
+    ''' Run the stages affected by the <changed> files, in order. The
+        outputs of a stage are changes for the next stages. '''
+    changed = set(os.path.relpath(f) for f in changed)
+    for stage in stages:
+        for src in stage.inputs():
+            deps = stage.dependencies(src)
+            if deps is None or deps & changed:
+                dst = stage.run(src)
+                if dst is not None:
+                    changed.add(dst)
+
+def record_missing_dependencies(stages):
+    ''' Render the inputs whose dependencies are unknown and then run
+        the next stages for what was rendered. '''
+    rendered = set()
+    for stage in stages:
+        if stage.recorded:
+            for src in stage.inputs():
+                if stage.dependencies(src) is None:
+                    dst = stage.run(src)
+                    if dst is not None:
+                        rendered.add(dst)
+
+    if rendered:
+        rebuild([stage for stage in stages if not stage.recorded], rendered)
+
+# Watchers
+# ========
+#
+# Both have a wait() method that blocks until some files change and
+# returns their paths.
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_ISDIR = 0x40000000
+IN_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+class InotifyWatcher:
+    def __init__(self, folders, settle=0.2):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.settle = settle
+        self.folders = {}
+        for top in folders:
+            for folder, _, _ in os.walk(top):
+                self.add(folder)
+
+    def add(self, folder):
+        wd = self._add_watch(self.fd, os.fsencode(folder), IN_MASK)
+        if wd >= 0:
+            self.folders[wd] = folder
+
+    def _read(self):
+        changed = set()
+        data = os.read(self.fd, 1 << 16)
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, size = struct.unpack_from('iIII', data, pos)
+            name = data[pos + 16:pos + 16 + size].rstrip(b'\0')
+            pos += 16 + size
+
+            path = os.path.join(self.folders.get(wd, ''), os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & IN_CREATE:
+                    self.add(path)
+                continue
+            changed.add(path)
+        return changed
+
+    def wait(self):
+        select.select([self.fd], [], [])
+        changed = self._read()
+
+        # editors write a file in several steps: wait for them
+        while select.select([self.fd], [], [], self.settle)[0]:
+            changed |= self._read()
+        return changed
+
+class PollingWatcher:
+    def __init__(self, folders, interval=1.0):
+        self.folders = folders
+        self.interval = interval
+        self.mtimes = self.scan()
+
+    def scan(self):
+        mtimes = {}
+        for top in self.folders:
+            for folder, _, fnames in os.walk(top):
+                for fname in fnames:
+                    path = os.path.join(folder, fname)
+                    try:
+                        mtimes[path] = os.stat(path).st_mtime_ns
+                    except OSError:
+                        pass
+        return mtimes
+
+    def wait(self):
+        while True:
+            time.sleep(self.interval)
+            mtimes = self.scan()
+            changed = set(p for p in mtimes.keys() | self.mtimes.keys()
+                            if mtimes.get(p) != self.mtimes.get(p))
+            self.mtimes = mtimes
+            if changed:
+                return changed
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog='watch',
+            description='Rebuild the parts of the book affected by each change.')
+    parser.add_argument('--main', action='store_true',
+            help='rebuild the main book too')
+    parser.add_argument('--poll', action='store_true',
+            help='poll the files instead of using inotify')
+    parser.add_argument('--interval', type=float, default=1.0,
+            help='seconds between polls (default: 1)')
+    args = parser.parse_args(argv)
+
+    stages = STAGES + (MAIN_STAGES if args.main else [])
+    record_missing_dependencies(stages)
+
+    # the sources and the folders of the extra dependencies (scripts/x/)
+    folders = [f for f in WATCHED if os.path.isdir(f)]
+    extra = set(os.path.dirname(f) for stage in stages for f in stage.extra)
+    folders += sorted(f for f in extra - set(folders) if os.path.isdir(f))
+    watcher = None
+    if not args.poll:
+        try:
+            watcher = InotifyWatcher(folders)
+        except OSError as err:
+            print('Cannot use inotify (%s), polling instead' % err, file=sys.stderr)
+    if watcher is None:
+        watcher = PollingWatcher(folders, args.interval)
+
+    print('Watching %s' % ', '.join(folders), flush=True)
+    try:
+        while True:
+            changed = watcher.wait()
+            print('Changed: %s' % ', '.join(sorted(changed)), flush=True)
+            begin = time.monotonic()
+            rebuild(stages, changed)
+            print('Rebuilt in %.1fs' % (time.monotonic() - begin), flush=True)
+    except KeyboardInterrupt:
+        return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+# Helpers for the content addressed caches kept on disk by pygmentex.py,
+# fmtcpp.py, fmtpng.py and j2_common.py (out/cache/...)
+#
+# The caches are shared by the processes that Tup runs in parallel so
+# the entries are written to a temporary file and then renamed: a
+# reader sees the whole entry or none. Reading an entry refreshes its
+# mtime so evict() considers it recently used.
+#
+# The scripts in this folder import it directly; the ones in scripts/
+# add this folder to sys.path first (see j2_common.py).
+
+import os, tempfile
+
+def read_entry(path, binary=False):
+    ''' Return the content of the entry <path> (str or bytes if <binary>)
+        or None if it does not exist, refreshing its mtime. '''
+    try:
+        if binary:
+            with open(path, 'rb') as f:
+                content = f.read()
+        else:
+            with open(path, 'rt', encoding='utf-8') as f:
+                content = f.read()
+    except OSError:
+        return None
+
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return content
+
+def write_entry(path, content):
+    ''' Write <content> (str or bytes) to the entry <path> atomically.
+
+        Errors are ignored: a cache that cannot be written is just a
+        cache miss the next time.
+    '''
+    folder = os.path.dirname(path)
+    try:
+        fd, tmp = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    except OSError:
+        return
+
+    try:
+        if isinstance(content, bytes):
+            f = os.fdopen(fd, 'wb')
+        else:
+            f = os.fdopen(fd, 'wt', encoding='utf-8')
+        with f:
+            f.write(content)
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+def evict(folder, max_size):
+    ''' Remove the entries in <folder> (and its subfolders) used least
+        recently until their total size is below <max_size> bytes.
+
+        The hidden files (like locks) and the entries being written are
+        left alone. Return how many entries were removed.
+    '''
+    entries = []
+    total = 0
+    for root, dirs, files in os.walk(folder):
+        for fname in files:
+            if fname.startswith('.') or fname.endswith('.tmp'):
+                continue
+            path = os.path.join(root, fname)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+    evicted = 0
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= max_size:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        total -= size
+        evicted += 1
+
+    return evicted
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# Format C/C++ sources with clang-format, caching the results.
+#
+# The formatted source depends only on the source, the style file
+# (scripts/x/.clang-format) and the version of clang-format. The
+# results are kept in out/cache/clang-format/ (or FMTCPP_CACHE_DIR) by
+# the hash of those so each source is formatted once.
+#
+# The sources not in the cache are formatted in batches, one
+# clang-format process per batch (and the batches in parallel),
+# instead of one process per source.
+#
+# Format one source (as the !fmtcpp rule of the Tupfile does):
+#
+#   ./scripts/x/fmtcpp.py <input> <output>
+#
+# Fill the cache with all the sources in src/ (useful before a fresh
+# build; out/t/src/ is left to Tup):
+#
+#   ./scripts/x/fmtcpp.py --all [-j <jobs>]
+
+import os, sys, glob, time, shutil, hashlib, argparse, tempfile, subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import cache_util
+
+STYLE_FILE = 'scripts/x/.clang-format'
+
+CACHE_DIR = os.getenv('FMTCPP_CACHE_DIR', 'out/cache/clang-format')
+
+SOURCES = ['src/*.j2.c', 'src/*.j2.h', 'src/*.j2.cpp']
+
+def clang_format_version():
+    ''' Return the output of clang-format --version.
+
+        It is kept in the cache too, by the path of the clang-format
+        binary and its mtime, so a source already in the cache does
+        not cost a clang-format process either.
+    '''
+    path = shutil.which('clang-format')
+    if path is None:
+        raise FileNotFoundError("clang-format is not in the PATH")
+    path = os.path.realpath(path)
+    stamp = '%s:%d' % (path, os.stat(path).st_mtime_ns)
+    entry = os.path.join(CACHE_DIR, 'version-' + hashlib.sha256(stamp.encode('utf-8')).hexdigest())
+
+    version = cache_util.read_entry(entry, binary=True)
+    if version is None:
+        version = subprocess.run([path, '--version'], check=True,
+                stdout=subprocess.PIPE).stdout
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        cache_util.write_entry(entry, version)
+    return version
+
+_key_prefix = None
+
+def key_prefix():
+    ''' Hash of the clang-format version and the style file, the part
+        of the cache keys shared by all the sources. '''
+    global _key_prefix
+    if _key_prefix is None:
+        version = clang_format_version()
+        with open(STYLE_FILE, 'rb') as f:
+            style = f.read()
+        _key_prefix = hashlib.sha256(version).hexdigest() + hashlib.sha256(style).hexdigest()
+    return _key_prefix
+
+def cache_key(data):
+    h = hashlib.sha256(key_prefix().encode('ascii'))
+    h.update(data)
+    return h.hexdigest()
+
+def format_batch(sources):
+    ''' Format the <sources> (bytes) with a single clang-format process
+        and return them formatted. '''
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=CACHE_DIR, suffix='.tmp') as tmpdir:
+        # clang-format looks for the style file from the folder of the
+        # source up (-style=file). The sources are named .cpp because
+        # the language of the stdin (how fmtcpp.sh used to format them)
+        # is C++ too
+        shutil.copyfile(STYLE_FILE, os.path.join(tmpdir, '.clang-format'))
+        names = []
+        for i, data in enumerate(sources):
+            name = os.path.join(tmpdir, '%d.cpp' % i)
+            with open(name, 'wb') as f:
+                f.write(data)
+            names.append(name)
+
+        subprocess.run(['clang-format', '-style=file', '-i'] + names, check=True)
+
+        formatted = []
+        for name in names:
+            with open(name, 'rb') as f:
+                formatted.append(f.read())
+        return formatted
+
+def format_sources(srcs, jobs=1):
+    ''' Format the files <srcs> and return them formatted (bytes) and
+        how many were in the cache. '''
+    keys = []
+    datas = {}
+    for src in srcs:
+        with open(src, 'rb') as f:
+            data = f.read()
+        key = cache_key(data)
+        keys.append(key)
+        datas[key] = data
+
+    results = {}
+    for key in datas:
+        data = cache_util.read_entry(os.path.join(CACHE_DIR, key), binary=True)
+        if data is not None:
+            results[key] = data
+    hits = len(results)
+
+    missing = [key for key in datas if key not in results]
+    if missing:
+        jobs = max(1, min(jobs, len(missing)))
+        batches = [missing[i::jobs] for i in range(jobs)]
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            formatted = pool.map(lambda batch: format_batch([datas[k] for k in batch]), batches)
+            for batch, outs in zip(batches, formatted):
+                for key, out in zip(batch, outs):
+                    cache_util.write_entry(os.path.join(CACHE_DIR, key), out)
+                    results[key] = out
+
+    return [results[key] for key in keys], hits
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog='fmtcpp',
+            description='Format C/C++ sources with clang-format, caching the results.')
+    parser.add_argument('--all', action='store_true',
+            help='fill the cache with all the sources in src/')
+    parser.add_argument('-j', dest='jobs', type=int, default=0,
+            help='batches to format in parallel with --all (default: 0, one per CPU)')
+    parser.add_argument('files', nargs='*', metavar='<input> <output>')
+    args = parser.parse_args(argv)
+
+    if args.all:
+        srcs = sorted(set(f for p in SOURCES for f in glob.glob(p)))
+        begin = time.monotonic()
+        _, hits = format_sources(srcs, args.jobs or os.cpu_count() or 1)
+        print("fmtcpp: %d sources, %d in the cache, %.1fs" % (
+            len(srcs), hits, time.monotonic() - begin))
+    elif len(args.files) == 2:
+        src, dst = args.files
+        (formatted,), _ = format_sources([src])
+        with open(dst, 'wb') as f:
+            f.write(formatted)
+    else:
+        parser.error('expected <input> <output> or --all')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
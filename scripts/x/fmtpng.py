@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# Optimize PNG images with optipng, caching the results.
+#
+# optipng -o7 is very slow but its result depends only on the input
+# image, the flags and the version of optipng. The optimized images are
+# kept in out/cache/optipng/ (or FMTPNG_CACHE_DIR) by the hash of those
+# so they are optimized once even if Tup's database is reset or the
+# project is checked out again.
+#
+# Optimize one image (as the !fmtpng rule of the Tupfile does):
+#
+#   ./scripts/x/fmtpng.py <input> <output>
+#
+# Fill the cache with all the images in z/img/, optimizing the ones not
+# in it in parallel, and report the bytes saved and the time spent
+# (useful before a fresh build; out/z/img/ is left to Tup):
+#
+#   ./scripts/x/fmtpng.py --all [-j <jobs>]
+
+import os, sys, glob, time, hashlib, argparse, tempfile, subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import cache_util
+
+OPTIPNG_FLAGS = ['-o7', '--strip', 'all', '-quiet']
+
+CACHE_DIR = os.getenv('FMTPNG_CACHE_DIR', 'out/cache/optipng')
+
+_optipng_version = None
+
+def optipng_version():
+    global _optipng_version
+    if _optipng_version is None:
+        out = subprocess.run(['optipng', '-v'], check=True,
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+        _optipng_version = out.decode('utf-8', 'replace').split('\n')[0].strip()
+    return _optipng_version
+
+def cache_key(data):
+    h = hashlib.sha256()
+    h.update(optipng_version().encode('utf-8'))
+    h.update(repr(OPTIPNG_FLAGS).encode('utf-8'))
+    h.update(data)
+    return h.hexdigest()
+
+def optimize(src, dst=None):
+    ''' Optimize the image <src> into <dst> (if given).
+
+        Return (size of <src>, size of the optimized image, whether it
+        was in the cache, seconds spent).
+    '''
+    begin = time.monotonic()
+    with open(src, 'rb') as f:
+        data = f.read()
+
+    cached = os.path.join(CACHE_DIR, cache_key(data) + '.png')
+    optimized = cache_util.read_entry(cached, binary=True)
+    hit = optimized is not None
+    if not hit:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+
+        # optipng does not overwrite files: let it write into a new
+        # folder and then put the result into the cache
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp = os.path.join(tmpdir, 'out.png')
+            subprocess.run(['optipng'] + OPTIPNG_FLAGS + ['-out', tmp, src], check=True)
+            with open(tmp, 'rb') as f:
+                optimized = f.read()
+        cache_util.write_entry(cached, optimized)
+
+    if dst is not None:
+        os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+        with open(dst, 'wb') as f:
+            f.write(optimized)
+    return len(data), len(optimized), hit, time.monotonic() - begin
+
+def optimize_all(jobs):
+    srcs = sorted(glob.glob('z/img/**/*.png', recursive=True))
+
+    begin = time.monotonic()
+    if jobs == 1:
+        results = list(map(optimize, srcs))
+    else:
+        # resolve the version once instead of in each worker
+        optipng_version()
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(optimize, srcs))
+    elapsed = time.monotonic() - begin
+
+    before = sum(r[0] for r in results)
+    after = sum(r[1] for r in results)
+    hits = sum(r[2] for r in results)
+    optimizing = sum(r[3] for r in results if not r[2])
+    print("fmtpng: %d images, %d in the cache, %d bytes -> %d bytes "
+          "(%d saved, %.1f%%), %.1fs optimizing the new ones, %.1fs in total" % (
+              len(results), hits, before, after, before - after,
+              (before - after) / before * 100 if before else 0, optimizing, elapsed))
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog='fmtpng',
+            description='Optimize PNG images with optipng, caching the results.')
+    parser.add_argument('--all', action='store_true',
+            help='fill the cache with all the images in z/img/')
+    parser.add_argument('-j', dest='jobs', type=int, default=0,
+            help='images to optimize in parallel with --all (default: 0, one per CPU)')
+    parser.add_argument('files', nargs='*', metavar='<input> <output>')
+    args = parser.parse_args(argv)
+
+    if args.all:
+        optimize_all(args.jobs or os.cpu_count() or 1)
+    elif len(args.files) == 2:
+        optimize(*args.files)
+    else:
+        parser.error('expected <input> <output> or --all')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,15 +3,37 @@
 set -e
 set -o pipefail
 
-# Call xelatex as usual
-xelatex "$@"
-
-# If we created a snippet to pygment and it was not pygmented yet,
-# do it now. The PYGMENTE_TARGET must be set by pdf.sh
+# The PYGMENTE_TARGET must be set by pdf.sh
 if [ -z "$PYGMENTE_TARGET" ]; then
     echo "PYGMENTE_TARGET was not set!"
     exit 1
 fi
-if [ -f "$PYGMENTE_TARGET.snippets" -a ! -f "$PYGMENTE_TARGET.pygmented" ]; then
-    ./scripts/x/pygmentex.py "$PYGMENTE_TARGET.snippets"
+
+# Before the first pass, write a .pygmented (and its manifest) for no
+# snippets at all. Tup expects both files even if the document has no
+# snippets to pygment (like when magic.py3 highlights the code itself,
+# see MAGIC_HIGHLIGHT in tex.sh). As these files do not change after
+# the pass in that case, latexmk does not do another pass for them.
+if [ ! -f "$PYGMENTE_TARGET.pygmented" -o ! -f "$PYGMENTE_TARGET.pygmented.manifest" ]; then
+    ./scripts/x/pygmentex.py -o "$PYGMENTE_TARGET.pygmented" /dev/null
+fi
+
+# Call xelatex as usual (timed, see stage-time.py)
+./scripts/x/stage-time.py xelatex "$PYGMENTE_TARGET" xelatex "$@"
+
+# Tell if the snippets are not the ones pygmented the last time
+# (pygmentex.py records their SHA-256 in the manifest)
+snippets_changed() {
+    local sum
+    sum="$(sha256sum < "$PYGMENTE_TARGET.snippets" | cut -d' ' -f1)"
+    ! grep -qF "\"snippets_sha256\": \"$sum\"" "$PYGMENTE_TARGET.pygmented.manifest" 2>/dev/null
+}
+
+# xelatex writes the snippets again in each pass: if they changed since
+# they were pygmented, pygment them again using the previous output as
+# a base so only the snippets that changed are highlighted.
+# Set PYGMENTEX_JOBS to highlight the snippets in parallel (see
+# pygmentex.py -j)
+if [ -f "$PYGMENTE_TARGET.snippets" ] && snippets_changed; then
+    ./scripts/x/stage-time.py pygmentex "$PYGMENTE_TARGET" ./scripts/x/pygmentex.py -b "$PYGMENTE_TARGET.pygmented" "$PYGMENTE_TARGET.snippets"
 fi
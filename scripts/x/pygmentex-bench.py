@@ -0,0 +1,697 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmarks for pygmentex.py
+
+Run them from the root of the project:
+
+    ./scripts/x/pygmentex-bench.py [<benchmark> ...]
+
+If no benchmark is given, all of them are run.
+"""
+
+import io
+import sys
+import glob
+import time
+import contextlib
+import tempfile
+import importlib.machinery
+import importlib.util
+import random
+import re
+
+import pygmentex
+from pygments.token import Token
+from pygments import highlight
+from pygments.lexer import Lexer
+from pygments.lexers import get_lexer_by_name
+from pygments.util import ClassNotFound
+from pygments.formatters.latex import escape_tex, _get_ttype_name
+from pygments.util import get_bool_opt, get_int_opt
+
+SNIPPET_CODES = [
+    'int main(int argc, char *argv[]) {\n'
+    '    printf("hola ~ %d\\n", argc); // comentario\n'
+    '    return 0;\n'
+    '}',
+
+    'struct A {\n'
+    '  int x;  /* a | b */\n'
+    '};\n'
+    '\n'
+    '  char *s = "$x$";',
+
+    '  +---+   +---+\n'
+    '  | a |-->| b |\n'
+    '  +---+   +---+',
+
+    'std::vector<int> v{1,2,3};\n'
+    'for (auto& x : v) { x *= 2; }',
+]
+
+SNIPPET_STYLES = ['candombe', 'candombefix', 'candombediagram', 'nostylediagram']
+
+def synthetic_snippets(count, seed=1):
+    r"""
+    Return the content of a synthetic .snippets file with ``count``
+    inlined and displayed snippets like the ones written by the
+    pygmentex LaTeX package.
+    """
+    rnd = random.Random(seed)
+    snippets = []
+    for n in range(count):
+        kind = rnd.choice(('display', 'display', 'inline'))
+        code = rnd.choice(SNIPPET_CODES)
+        if kind == 'inline':
+            code = code.split('\n')[0]
+
+        opts = 'lang=c,sty=default,linenosep=0pt,lang=%s, boxrule=0pt, frame empty, sty=%s' % (
+                rnd.choice(('c', 'cpp')), rnd.choice(SNIPPET_STYLES))
+        if rnd.random() < .2:
+            opts += ',linenos,linenostart=3,linenostep=2'
+        if rnd.random() < .2:
+            opts += ',escapeinside=||'
+        if rnd.random() < .1:
+            opts += ',gobble=2'
+
+        snippets.append('<@@pygmented@%s@%d\n%s\n%s\n>@@pygmented@%s@%d' % (
+            kind, n, opts, code, kind, n))
+
+    return '\n'.join(snippets) + '\n'
+
+
+# Corner cases of the .snippets format: empty texts, texts with end
+# markers of other kinds or numbers and texts with lines that look like
+# markers but are not at the begin/end of a line.
+SNIPPETS_CORNER_CASES = [
+    '<@@pygmented@display@1\nlang=c\n\n>@@pygmented@display@1\n',
+    '<@@pygmented@display@1\nlang=c\nint a;\n>@@pygmented@display@10\n>@@pygmented@inline@1\n>@@pygmented@display@1\n',
+    '<@@pygmented@inline@7\nlang=c\nx >@@pygmented@inline@7\n>@@pygmented@inline@7 y\n>@@pygmented@inline@7\n',
+    '<@@pygmented@display@2\nlang=c\n\n\nint\n\n>@@pygmented@display@2\n\n\n<@@pygmented@inline@3\nsty=candombe\n`ñandú`\n>@@pygmented@inline@3',
+    '<@@pygmented@display@4\nlang=c\n>@@pygmented@display@4\n\n>@@pygmented@display@4\n',
+    '<@@pygmented@display@5\nlang=c\nint a;\n>@@pygmented@display@5\n  <@@pygmented@display@6\nlang=c\nint b;\n>@@pygmented@display@6\n',
+    '<@@pygmented@display@8\nlang=c\nint a;\n>@@pygmented@display@8\ngarbage\n',
+    '<@@pygmented@display@9\nlang=c\nint a;\n',
+    '<@@pygmented@foo@9\nlang=c\nint a;\n>@@pygmented@foo@9\n',
+    '\n\n',
+    '',
+]
+
+_re_display = re.compile(
+    r'^<@@pygmented@display@(\d+)\n(.*)\n([\s\S]*?)\n>@@pygmented@display@\1$',
+    re.MULTILINE)
+
+_re_inline = re.compile(
+    r'^<@@pygmented@inline@(\d+)\n(.*)\n([\s\S]*?)\n>@@pygmented@inline@\1$',
+    re.MULTILINE)
+
+_re_input = re.compile(
+    r'^<@@pygmented@input@(\d+)\n(.*)\n([\s\S]*?)\n>@@pygmented@input@\1$',
+    re.MULTILINE)
+
+def regex_scan_snippets(code):
+    r"""
+    Reference implementation of pygmentex.scan_snippets: the original
+    one that tries a regex per kind at each position.
+    """
+    pos = 0
+    while pos < len(code):
+        if code[pos].isspace():
+            pos = pos + 1
+            continue
+
+        for kind, regex in (('inline', _re_inline), ('display', _re_display), ('input', _re_input)):
+            m = regex.match(code, pos)
+            if m:
+                yield kind, m.group(1), m.group(2), m.group(3)
+                pos = m.end()
+                break
+        else:
+            break
+
+
+class ReferenceLatexFormatter(pygmentex.EnhancedLatexFormatter):
+    r"""
+    Reference implementation of EnhancedLatexFormatter.format_unencoded:
+    the original one that computes the styles of each token and writes
+    them piece by piece.
+    """
+    def format_unencoded(self, tokensource, outfile):
+        t2n = self.ttype2name
+        cp = self.commandprefix
+
+        outfile.write(r'\begin{Verbatim}[commandchars=\\\{\}')
+        if self.linenos:
+            start, step = self.linenostart, self.linenostep
+            outfile.write(',numbers=left' +
+                          (start and ',firstnumber=%d' % start or '') +
+                          (step and ',stepnumber=%d' % step or ''))
+        if self.mathescape or self.texcomments or self.escapeinside:
+            outfile.write(r',codes={\catcode`\$=3\catcode`\^=7\catcode`\_=8}')
+        if self.verboptions:
+            outfile.write(',' + self.verboptions)
+        outfile.write(']\n')
+
+        for ttype, value in tokensource:
+            if ttype in Token.Comment:
+                if self.texcomments:
+                    start = value[0:1]
+                    for i in range(1, len(value)):
+                        if start[0] != value[i]:
+                            break
+                        start += value[i]
+
+                    value = value[len(start):]
+                    start = escape_tex(start, self.commandprefix)
+                    value = start + value
+                elif self.mathescape:
+                    parts = value.split('$')
+                    in_math = False
+                    for i, part in enumerate(parts):
+                        if not in_math:
+                            parts[i] = escape_tex(part, self.commandprefix)
+                        in_math = not in_math
+                    value = '$'.join(parts)
+                elif self.escapeinside:
+                    text = value
+                    value = ''
+                    while len(text) > 0:
+                        a,sep1,text = text.partition(self.left)
+                        if len(sep1) > 0:
+                            b,sep2,text = text.partition(self.right)
+                            if len(sep2) > 0:
+                                value += escape_tex(a, self.commandprefix) + b
+                            else:
+                                value += escape_tex(a + sep1 + b, self.commandprefix)
+                        else:
+                            value = value + escape_tex(a, self.commandprefix)
+                else:
+                    value = escape_tex(value, self.commandprefix)
+            elif ttype not in Token.Escape:
+                value = escape_tex(value, self.commandprefix)
+            styles = []
+            while ttype is not Token:
+                try:
+                    styles.append(t2n[ttype])
+                except KeyError:
+                    styles.append(_get_ttype_name(ttype))
+                ttype = ttype.parent
+            styleval = '+'.join(reversed(styles))
+            if styleval:
+                spl = value.split('\n')
+                for line in spl[:-1]:
+                    if line:
+                        outfile.write("\\%s{%s}{%s}" % (cp, styleval, line))
+                    outfile.write('\n')
+                if spl[-1]:
+                    outfile.write("\\%s{%s}{%s}" % (cp, styleval, spl[-1]))
+            else:
+                outfile.write(value)
+
+        outfile.write('\\end{Verbatim}\n')
+
+
+class ReferenceLatexEmbeddedLexer(Lexer):
+    r"""
+    Reference implementation of pygmentex.LatexEmbeddedLexer: the
+    original one that grows the merged text token by token and
+    partitions it again at each escaped segment.
+    """
+    def __init__(self, left, right, lang, **options):
+        self.left = left
+        self.right = right
+        self.lang = lang
+        Lexer.__init__(self, **options)
+
+    def get_tokens_unprocessed(self, text):
+        buf = ''
+        for i, t, v in self.lang.get_tokens_unprocessed(text):
+            if t in Token.Comment or t in Token.String:
+                if buf:
+                    for x in self.get_tokens_aux(idx, buf):
+                        yield x
+                    buf = ''
+                yield i, t, v
+            else:
+                if not buf:
+                    idx = i
+                buf += v
+        if buf:
+            for x in self.get_tokens_aux(idx, buf):
+                yield x
+
+    def get_tokens_aux(self, index, text):
+        while text:
+            a, sep1, text = text.partition(self.left)
+            if a:
+                for i, t, v in self.lang.get_tokens_unprocessed(a):
+                    yield index + i, t, v
+                    index += len(a)
+            if sep1:
+                b, sep2, text = text.partition(self.right)
+                if sep2:
+                    yield index + len(sep1), Token.Escape, b
+                    index += len(sep1) + len(b) + len(sep2)
+                else:
+                    yield index, Token.Error, sep1
+                    index += len(sep1)
+                    text = b
+
+
+_re_fence = re.compile(r'^```([\w;]+)[^\n]*\n([\s\S]*?)\n```$', re.MULTILINE)
+
+def book_snippets():
+    r"""
+    Return the language and the code of the code blocks of the book
+    (the ones in parts/ and main/) and of the C sources in src/.
+    """
+    snippets = []
+    for fname in sorted(glob.glob('parts/*.md') + glob.glob('main/*.md')):
+        with open(fname, 'rt') as f:
+            snippets.extend((m.group(1).split(';')[0], m.group(2))
+                            for m in _re_fence.finditer(f.read()))
+
+    for fname in sorted(glob.glob('src/*')):
+        with open(fname, 'rt') as f:
+            snippets.append(('c', f.read()))
+
+    return snippets
+
+
+_re_inline_code = re.compile(r'`([^`\n]+)`(?:\{\.([\w;]+)\})?')
+
+def book_code():
+    r"""
+    Return the classes, the code and if it is inlined of the code of
+    the book (the code blocks and the inline code, C++ by default, of
+    parts/ and main/) as the Pandoc filter sees them.
+    """
+    code = []
+    for fname in sorted(glob.glob('parts/*.md') + glob.glob('main/*.md')):
+        with open(fname, 'rt') as f:
+            text = f.read()
+        code.extend((m.group(1), m.group(2), False) for m in _re_fence.finditer(text))
+        code.extend((m.group(2) or 'cpp', m.group(1), True)
+                    for m in _re_inline_code.finditer(_re_fence.sub('', text)))
+
+    return code
+
+
+def load_magic():
+    loader = importlib.machinery.SourceFileLoader('magic', 'scripts/x/magic.py3')
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+# Delimiters for escapeinside: some of them are common in the code
+# (|| and <> in C++, ( and ) everywhere) so there are unclosed escapes
+# and escapes that cut tokens
+ESCAPE_DELIMITERS = ['||', '@@', '$$', '<>', '!!', '()']
+
+def synthetic_c_file(nlines, seed=1):
+    r"""
+    Return a C source of about ``nlines`` lines made of the snippets'
+    codes plus comments with escaped LaTeX (``|...|``), math (``$...$``)
+    and multi-line comments.
+    """
+    rnd = random.Random(seed)
+    extra = [
+        '/* see |\\textbf{this}| and $x^2$ */\n'
+        'int f(int x) { return x * x; } // |\\ref{sec}| and 50% of #x\n',
+        '/* a\n   multi-line\n   comment with ~ and _ */\n',
+        ]
+    lines = []
+    while len(lines) < nlines:
+        lines.extend(rnd.choice(SNIPPET_CODES + extra).split('\n'))
+    return '\n'.join(lines[:nlines]) + '\n'
+
+
+def reference_pyg(opts, text, inline_delim=''):
+    r"""
+    Reference implementation of pygmentex.pyg: the original one that
+    highlights the snippet into a Verbatim environment and parses it
+    back.
+    """
+    lexer = pygmentex.get_lexer(opts)
+    _fmter, honorspacewidth = pygmentex.make_formatter(opts)
+
+    x = highlight(text, lexer, _fmter)
+
+    m = re.match(r'\\begin\{Verbatim}(.*)\n([\s\S]*?)\n\\end\{Verbatim}(\s*)\Z',
+                 x)
+    if m:
+        linenos = get_bool_opt(opts, 'linenos', False)
+        linenostart = abs(get_int_opt(opts, 'linenostart', 1))
+        linenostep = abs(get_int_opt(opts, 'linenostep', 1))
+        lines0 = m.group(2).split('\n')
+        numbers = []
+        lines = []
+        counter = linenostart
+        for line in lines0:
+            line = re.sub(r'^ ', r'\\makebox[0pt]{\\phantom{Xy}} ', line)
+            line = re.sub(r' ', '~', line)
+            if linenos:
+                if (counter - linenostart) % linenostep == 0:
+                    line = r'\pygmented@lineno@do{' + str(counter) + '}' + line
+                    numbers.append(str(counter))
+                counter = counter + 1
+            lines.append(line)
+
+        if honorspacewidth and not inline_delim:
+            lines = [l.replace('~',r'\hphantom{m}') for l in lines]
+
+        return numbers, '\\newline\n'.join(lines)
+
+    return None
+
+
+def reference_style_defs(opts):
+    r"""
+    Reference implementation of pygmentex.style_defs: the original one
+    that builds the formatter of the snippet and rewrites its
+    get_style_defs.
+    """
+    _fmter, _ = pygmentex.make_formatter(opts)
+    styledefs = _fmter.get_style_defs() \
+        .replace('#', '##') \
+        .replace(r'\##', r'\#') \
+        .replace(r'\makeatletter', '') \
+        .replace(r'\makeatother', '') \
+        .replace('\n', '%\n')
+    return '\\def\\PYstyle{0}{{%\n{1}%\n}}%\n'.format(opts['sty'], styledefs)
+
+
+# Snippets' texts for the comparisons of pyg: spaces and ~ at the begin
+# and inside escaped parts, empty lines and texts, and comments for
+# texcomments/mathescape
+PYG_CORNER_CASES = [
+    '',
+    '\n',
+    '\n\n  \n',
+    ' a ~ b',
+    '  int x; /* |\\textbf{ a ~ b }| */\n\n\tchar c;  \n',
+    '// $x ~ y$ and _ ^ # % & { } \\ \n  // ~~ ~\n',
+    '  +---+ ~ +---+\n  |   |   |   |\n  +---+   +---+\n\n',
+    'x /* |unclosed escape */ y',
+    'printf("%d ~ \\n", 1); // ñandú\r\nz',
+    ]
+
+
+def timeit(fn, *args):
+    begin = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - begin
+
+
+def bench_registry(count=5000):
+    r"""
+    Per-snippet cost of pyg() building the lexer and formatter for
+    each snippet versus reusing them from the registry.
+    """
+    snippets = list(pygmentex.parse_snippets(synthetic_snippets(count)))
+
+    def without_registry():
+        for n, opts, text, inline_delim in snippets:
+            pygmentex._lexers.clear()
+            pygmentex._formatters.clear()
+            pygmentex.pyg(opts, text, inline_delim)
+
+    def with_registry():
+        pygmentex._lexers.clear()
+        pygmentex._formatters.clear()
+        for n, opts, text, inline_delim in snippets:
+            pygmentex.pyg(opts, text, inline_delim)
+
+    before = timeit(without_registry)
+    after = timeit(with_registry)
+    print('registry: %d snippets, %.1f us/snippet without, %.1f us/snippet with (x%.1f)' % (
+        count, before / count * 1e6, after / count * 1e6, before / after))
+
+
+def bench_scanner(count=20000):
+    r"""
+    Scan a synthetic .snippets file (and the corner cases) with the
+    original regex-based scanner and with the single-pass scanner,
+    checking that both yield the same snippets.
+    """
+    # the invalid corner cases are reported in stderr, ignore them
+    with contextlib.redirect_stderr(io.StringIO()):
+        for code in SNIPPETS_CORNER_CASES:
+            expected = list(regex_scan_snippets(code))
+            assert list(pygmentex.scan_snippets(code)) == expected, code
+            assert list(pygmentex.scan_snippets(code.encode('utf-8'))) == expected, code
+
+    long_text = '\n'.join('    x = foo(%d); // line' % i for i in range(300))
+    long_snippets = ''.join(
+        '<@@pygmented@display@%d\nlang=c\n%s\n>@@pygmented@display@%d\n' % (
+            n, long_text, n) for n in range(count // 40))
+
+    for what, code in (('short', synthetic_snippets(count)), ('long', long_snippets)):
+        expected = list(regex_scan_snippets(code))
+        assert list(pygmentex.scan_snippets(code)) == expected
+        assert list(pygmentex.scan_snippets(code.encode('utf-8'))) == expected
+
+        before = timeit(lambda: list(regex_scan_snippets(code)))
+        after = timeit(lambda: list(pygmentex.scan_snippets(code)))
+        print('scanner: %d %s snippets, %.1f ms with regexs, %.1f ms single-pass (x%.1f)' % (
+            len(expected), what, before * 1e3, after * 1e3, before / after))
+
+
+def bench_formatter(nlines=20000):
+    r"""
+    Highlight a C file of ``nlines`` lines with the original
+    format_unencoded and with the one that uses the precomputed
+    ``\PY{...}`` prefixes and batched writes, checking that both give
+    the same output for each of the escaping options.
+    """
+    code = synthetic_c_file(nlines)
+    variants = [{}, {'escapeinside': '||'}, {'texcomments': 'true'}, {'mathescape': 'true'}]
+    for variant in variants:
+        opts = dict(lang='c', sty='candombe', **variant)
+        lexer = pygmentex.get_lexer(opts)
+        fmter, _ = pygmentex.make_formatter(opts)
+
+        reference = ReferenceLatexFormatter()
+        reference.__dict__.update(fmter.__dict__)
+
+        tokens = list(lexer.get_tokens(code))
+        expected = io.StringIO()
+        reference.format_unencoded(iter(tokens), expected)
+        got = io.StringIO()
+        fmter.format_unencoded(iter(tokens), got)
+        assert got.getvalue() == expected.getvalue(), variant
+
+        before = timeit(lambda: reference.format_unencoded(iter(tokens), io.StringIO()))
+        after = timeit(lambda: fmter.format_unencoded(iter(tokens), io.StringIO()))
+        print('formatter: %d lines, %d tokens, %s: %.1f ms before, %.1f ms after (x%.1f)' % (
+            nlines, len(tokens), variant or 'no escapes', before * 1e3, after * 1e3, before / after))
+
+
+def bench_pyg(count=5000):
+    r"""
+    Highlight ``count`` synthetic snippets with the original pyg, that
+    re-parses the Verbatim output, and with the one that emits the
+    snippet body directly from the tokens, checking that both give the
+    same results (on the corner cases too).
+    """
+    variants = [{}, {'escapeinside': '||'}, {'texcomments': 'true'}, {'mathescape': 'true'},
+                {'linenos': True, 'linenostart': '3', 'linenostep': '2'}, {'gobble': '2'}]
+    for sty in SNIPPET_STYLES:
+        for variant in variants:
+            for text in PYG_CORNER_CASES + SNIPPET_CODES:
+                for inline_delim in ('', '|'):
+                    opts = dict(lang='c', sty=sty, **variant)
+                    expected = reference_pyg(opts, text, inline_delim)
+                    assert pygmentex.pyg(opts, text, inline_delim) == expected, (opts, text, inline_delim)
+
+    short = list(pygmentex.parse_snippets(synthetic_snippets(count)))
+    code = synthetic_c_file(count * 10).split('\n')
+    long = [(n, dict(lang='c', sty='candombefix'), '\n'.join(code[i:i+200]), '')
+            for n, i in enumerate(range(0, len(code), 200))]
+
+    for what, snippets in (('short', short), ('200-line', long)):
+        for n, opts, text, inline_delim in snippets:
+            assert pygmentex.pyg(opts, text, inline_delim) == reference_pyg(opts, text, inline_delim)
+
+        def run(fn):
+            for n, opts, text, inline_delim in snippets:
+                fn(opts, text, inline_delim)
+
+        before = timeit(run, reference_pyg)
+        after = timeit(run, pygmentex.pyg)
+        count = len(snippets)
+        print('pyg: %d %s snippets, %.1f us/snippet re-parsing Verbatim, %.1f us/snippet direct (x%.2f)' % (
+            count, what, before / count * 1e6, after / count * 1e6, before / after))
+
+
+def bench_lexer(nlines=20000):
+    r"""
+    Lex the book's snippets with each of the ESCAPE_DELIMITERS, with
+    and without added escapes, and a C file of ``nlines`` lines with
+    an escape in each line using the original LatexEmbeddedLexer and
+    the linear one.
+
+    The token streams must be identical and the indexes of the tokens
+    must be right (the original ones were wrong after the first token
+    of each text between escapes).
+    """
+    rnd = random.Random(1)
+    texts = []
+    for lang, code in book_snippets():
+        try:
+            lang_lexer = get_lexer_by_name(lang)
+        except ClassNotFound:
+            continue
+
+        for delims in ESCAPE_DELIMITERS:
+            escaped = code
+            for pos in sorted(rnd.sample(range(len(code) + 1), min(5, len(code) + 1)), reverse=True):
+                escaped = escaped[:pos] + delims[0] + r'\textbf{x}' + delims[1] + escaped[pos:]
+            texts.append((lang_lexer, delims, code))
+            texts.append((lang_lexer, delims, escaped))
+
+    c = get_lexer_by_name('c')
+    long = [(c, '||', synthetic_c_file(nlines).replace('\n', ' |$x_{1}$| ;\n'))]
+
+    for lang_lexer, delims, text in texts + long:
+        lexer = pygmentex.LatexEmbeddedLexer(delims[0], delims[1], lang_lexer)
+        reference = ReferenceLatexEmbeddedLexer(delims[0], delims[1], lang_lexer)
+
+        end = 0
+        for i, t, v in lexer.get_tokens_unprocessed(text):
+            assert i >= end and text[i:i+len(v)] == v, (text, i, t, v)
+            end = i + len(v)
+
+        assert list(lexer.get_tokens(text)) == list(reference.get_tokens(text)), (delims, text)
+
+    print('lexer: %d token streams of the book snippets, all identical to the original ones' % (
+              len(texts)))
+
+    for what, texts in (('book snippets', texts), ('%d-line C file' % nlines, long)):
+        def run(cls):
+            for lang_lexer, delims, text in texts:
+                for _ in cls(delims[0], delims[1], lang_lexer).get_tokens(text):
+                    pass
+
+        before = timeit(run, ReferenceLatexEmbeddedLexer)
+        after = timeit(run, pygmentex.LatexEmbeddedLexer)
+        print('lexer: %s, %.1f ms growing the text, %.1f ms joining it (x%.2f)' % (
+            what, before * 1e3, after * 1e3, before / after))
+
+
+def bench_styles(rounds=200):
+    r"""
+    Generate the definitions of the styles of a document as a new
+    pygmentex run does, with the original code that builds a formatter
+    for each style and with the definitions taken from the cache (of
+    a previous run), checking that both give the same definitions.
+    """
+    stylenames = SNIPPET_STYLES + ['default', 'emacs']
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = pygmentex.SnippetCache(tmpdir, 1 << 20)
+        for stylename in stylenames:
+            expected = reference_style_defs(dict(sty=stylename))
+            pygmentex._style_defs.clear()
+            assert pygmentex.style_defs(stylename) == expected, stylename
+            pygmentex._style_defs.clear()
+            assert pygmentex.style_defs(stylename, cache) == expected, stylename
+            pygmentex._style_defs.clear()
+            assert pygmentex.style_defs(stylename, cache) == expected, stylename
+
+        def run(generate):
+            for _ in range(rounds):
+                pygmentex._formatters.clear()
+                pygmentex._style_defs.clear()
+                for stylename in stylenames:
+                    generate(stylename)
+
+        before = timeit(run, lambda stylename: reference_style_defs(dict(sty=stylename)))
+        generated = timeit(run, pygmentex.style_defs)
+        cached = timeit(run, lambda stylename: pygmentex.style_defs(stylename, cache))
+        print('styles: %d styles, %.2f ms/run building formatters, %.2f ms/run by style class, '
+              '%.2f ms/run from the cache (x%.1f)' % (
+                  len(stylenames), before / rounds * 1e3, generated / rounds * 1e3,
+                  cached / rounds * 1e3, before / cached))
+
+
+def bench_magic(rounds=3):
+    r"""
+    Highlight the code of the book in the Pandoc filter as it does with
+    MAGIC_HIGHLIGHT=1, checking that it gives the same snippets as
+    pygmentex.py for the .snippets file that xelatex writes otherwise.
+    """
+    magic = load_magic()
+
+    snippets = []
+    for classes, code, inline in book_code():
+        lang, *flags = classes.split(';')
+        if lang == 'none' or not magic.is_known_language(lang):
+            continue
+
+        head, tail, diagram = magic.pygmentex_attributes(lang, tuple(flags))
+        if diagram:
+            head += ', ' + magic.kwargs_as_latex_options({
+                'center': None,
+                'width': r'%s\linewidth' % magic.diagram_width_ratio(code),
+                })
+        snippets.append((head + tail, code, inline))
+
+    # the .snippets file as xelatex writes it: with the global options
+    # (see \setpygmented) and without the spaces at the end of the lines
+    # of the code blocks
+    written = []
+    for n, (attrs, code, inline) in enumerate(snippets):
+        if not inline:
+            code = '\n'.join(line.rstrip(' ') for line in code.split('\n'))
+        kind = 'inline' if inline else 'display'
+        written.append('<@@pygmented@%s@%d\n%s,%s\n%s\n>@@pygmented@%s@%d\n' % (
+            kind, n, r'/pygmented/.cd,font=\monacofont \small ,boxing method=tcolorbox,'
+            'inline method=tcbox', attrs, code, kind, n))
+
+    expected = [pygmentex.pyg(opts, text, inline_delim)
+                for n, opts, text, inline_delim in pygmentex.parse_snippets(''.join(written))]
+    assert len(expected) == len(snippets)
+    for (attrs, code, inline), result in zip(snippets, expected):
+        sty, numbers, body = magic.highlight_with_pygmentex(attrs, code, inline)
+        body = body.replace(r'\pygmentedlineno{', r'\pygmented@lineno@do{')
+        assert (numbers, body) == result, (attrs, code)
+
+    def run():
+        for attrs, code, inline in snippets:
+            magic.highlight_with_pygmentex(attrs, code, inline)
+
+    elapsed = min(timeit(run) for _ in range(rounds))
+    print('magic: %d blocks and %d inline code of the book, the same snippets as pygmentex.py, '
+          '%.1f ms highlighting them in the filter' % (
+              sum(not s[2] for s in snippets), sum(s[2] for s in snippets), elapsed * 1e3))
+
+
+BENCHMARKS = {
+    'registry': bench_registry,
+    'scanner': bench_scanner,
+    'formatter': bench_formatter,
+    'pyg': bench_pyg,
+    'lexer': bench_lexer,
+    'styles': bench_styles,
+    'magic': bench_magic,
+    }
+
+def main(args = sys.argv):
+    names = args[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print('Unknown benchmark %s, expected one of: %s' % (
+                name, ', '.join(BENCHMARKS)), file=sys.stderr)
+            return 2
+
+        BENCHMARKS[name]()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
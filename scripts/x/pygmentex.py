@@ -12,22 +12,30 @@
     :license: BSD, see LICENSE for details
 """
 
-__version__ = '0.10'
+__version__ = '0.11'
 __docformat__ = 'restructuredtext'
 
 import sys
+import os
 import getopt
 import re
+import hashlib
+import json
+import mmap
+import fcntl
 from os.path import splitext
+from concurrent.futures import ProcessPoolExecutor
 
-from pygments import highlight
+import cache_util
+
+import pygments
 from pygments.styles import get_style_by_name
 from pygments.lexers import get_lexer_by_name
 from pygments.formatters.latex import LatexFormatter, escape_tex, _get_ttype_name
 from pygments.util import get_bool_opt, get_int_opt
 from pygments.lexer import Lexer
 from pygments.token import Token
-from pygments.util import guess_decode
+from pygments.util import guess_decode, ClassNotFound
 
 
 # ----------------------
@@ -156,89 +164,164 @@ class EnhancedLatexFormatter(LatexFormatter):
         else:
             self.escapeinside = ''
 
+    def escape(self, text):
+        r"""
+        Same as ``escape_tex(text, self.commandprefix)`` but in a single
+        pass with ``str.translate``.
+
+        ``escape_tex`` replaces characters one by one so its table is
+        computed once from it (and checked, falling back to it if it
+        does something else).
+        """
+        table = self._escape_table
+        if table is None:
+            cp = self.commandprefix
+            probe = ''.join(map(chr, range(256)))
+            table = {ord(c): escape_tex(c, cp) for c in probe if escape_tex(c, cp) != c}
+            if probe.translate(table) != escape_tex(probe, cp):
+                table = False
+            self._escape_table = table
+
+        if table is False:
+            return escape_tex(text, self.commandprefix)
+        return text.translate(table)
+
+    def _create_stylesheet(self):
+        LatexFormatter._create_stylesheet(self)
+        # the prefixes depend on the style, see style_prefix
+        self._prefixes = {}
+        self._escape_table = None
+
+    def style_prefix(self, ttype):
+        r"""
+        Return the ``\PY{<styles>}{`` prefix of the tokens of type
+        ``ttype`` or an empty string if the type has no style.
+
+        The prefixes are computed once per token type: the set of types
+        is small and they do not change for a formatter and its style.
+        """
+        prefix = self._prefixes.get(ttype)
+        if prefix is None:
+            t2n = self.ttype2name
+            styles = []
+            t = ttype
+            while t is not Token:
+                try:
+                    styles.append(t2n[t])
+                except KeyError:
+                    # not in current style
+                    styles.append(_get_ttype_name(t))
+                t = t.parent
+            styleval = '+'.join(reversed(styles))
+            prefix = "\\%s{%s}{" % (self.commandprefix, styleval) if styleval else ''
+            self._prefixes[ttype] = prefix
+        return prefix
+
+    def escape_inside(self, text):
+        r"""
+        Escape ``text`` for TeX except the parts between the
+        ``escapeinside`` delimiters, which are passed as they are
+        (without the delimiters).
+        """
+        parts = []
+        while len(text) > 0:
+            a,sep1,text = text.partition(self.left)
+            if len(sep1) > 0:
+                b,sep2,text = text.partition(self.right)
+                if len(sep2) > 0:
+                    parts.append(self.escape(a))
+                    parts.append(b)
+                else:
+                    parts.append(self.escape(a + sep1 + b))
+            else:
+                parts.append(self.escape(a))
+        return ''.join(parts)
+
+    def escape_token(self, ttype, value):
+        r"""
+        Escape the ``value`` of a token for TeX according to its type
+        and the escaping options (texcomments, mathescape and
+        escapeinside).
+        """
+        if ttype in Token.Comment:
+            if self.texcomments:
+                # Try to guess comment starting lexeme and escape it ...
+                start = value[0:1]
+                for i in range(1, len(value)):
+                    if start[0] != value[i]:
+                        break
+                    start += value[i]
+
+                value = value[len(start):]
+                start = self.escape(start)
+
+                # ... but do not escape inside comment.
+                value = start + value
+            elif self.mathescape:
+                # Only escape parts not inside a math environment.
+                parts = value.split('$')
+                in_math = False
+                for i, part in enumerate(parts):
+                    if not in_math:
+                        parts[i] = self.escape(part)
+                    in_math = not in_math
+                value = '$'.join(parts)
+            elif self.escapeinside:
+                value = self.escape_inside(value)
+            else:
+                value = self.escape(value)
+        elif ttype not in Token.Escape:
+            value = self.escape(value)
+        return value
+
+    def format_tokens(self, tokensource, write):
+        r"""
+        Escape and style the tokens, passing the pieces of the output
+        to ``write``. The lines are separated by newlines.
+        """
+        for ttype, value in tokensource:
+            value = self.escape_token(ttype, value)
+            prefix = self.style_prefix(ttype)
+            if not prefix:
+                write(value)
+            elif '\n' not in value:
+                if value:
+                    write(prefix + value + '}')
+            else:
+                spl = value.split('\n')
+                for line in spl[:-1]:
+                    if line:
+                        write(prefix + line + '}')
+                    write('\n')
+                if spl[-1]:
+                    write(prefix + spl[-1] + '}')
+
     def format_unencoded(self, tokensource, outfile):
         # TODO: add support for background colors
-        t2n = self.ttype2name
-        cp = self.commandprefix
-
         if self.full:
             realoutfile = outfile
             outfile = StringIO()
 
-        outfile.write(r'\begin{Verbatim}[commandchars=\\\{\}')
+        # the output is collected here and written at once
+        out = []
+        write = out.append
+
+        write(r'\begin{Verbatim}[commandchars=\\\{\}')
         if self.linenos:
             start, step = self.linenostart, self.linenostep
-            outfile.write(',numbers=left' +
+            write(',numbers=left' +
                           (start and ',firstnumber=%d' % start or '') +
                           (step and ',stepnumber=%d' % step or ''))
         if self.mathescape or self.texcomments or self.escapeinside:
-            outfile.write(r',codes={\catcode`\$=3\catcode`\^=7\catcode`\_=8}')
+            write(r',codes={\catcode`\$=3\catcode`\^=7\catcode`\_=8}')
         if self.verboptions:
-            outfile.write(',' + self.verboptions)
-        outfile.write(']\n')
+            write(',' + self.verboptions)
+        write(']\n')
 
-        for ttype, value in tokensource:
-            if ttype in Token.Comment:
-                if self.texcomments:
-                    # Try to guess comment starting lexeme and escape it ...
-                    start = value[0:1]
-                    for i in range(1, len(value)):
-                        if start[0] != value[i]:
-                            break
-                        start += value[i]
-
-                    value = value[len(start):]
-                    start = escape_tex(start, self.commandprefix)
-
-                    # ... but do not escape inside comment.
-                    value = start + value
-                elif self.mathescape:
-                    # Only escape parts not inside a math environment.
-                    parts = value.split('$')
-                    in_math = False
-                    for i, part in enumerate(parts):
-                        if not in_math:
-                            parts[i] = escape_tex(part, self.commandprefix)
-                        in_math = not in_math
-                    value = '$'.join(parts)
-                elif self.escapeinside:
-                    text = value
-                    value = ''
-                    while len(text) > 0:
-                        a,sep1,text = text.partition(self.left)
-                        if len(sep1) > 0:
-                            b,sep2,text = text.partition(self.right)
-                            if len(sep2) > 0:
-                                value += escape_tex(a, self.commandprefix) + b
-                            else:
-                                value += escape_tex(a + sep1 + b, self.commandprefix)
-                        else:
-                            value = value + escape_tex(a, self.commandprefix)
-                else:
-                    value = escape_tex(value, self.commandprefix)
-            elif ttype not in Token.Escape:
-                value = escape_tex(value, self.commandprefix)
-            styles = []
-            while ttype is not Token:
-                try:
-                    styles.append(t2n[ttype])
-                except KeyError:
-                    # not in current style
-                    styles.append(_get_ttype_name(ttype))
-                ttype = ttype.parent
-            styleval = '+'.join(reversed(styles))
-            if styleval:
-                spl = value.split('\n')
-                for line in spl[:-1]:
-                    if line:
-                        outfile.write("\\%s{%s}{%s}" % (cp, styleval, line))
-                    outfile.write('\n')
-                if spl[-1]:
-                    outfile.write("\\%s{%s}{%s}" % (cp, styleval, spl[-1]))
-            else:
-                outfile.write(value)
+        self.format_tokens(tokensource, write)
 
-        outfile.write('\\end{Verbatim}\n')
+        write('\\end{Verbatim}\n')
+        outfile.write(''.join(out))
 
         if self.full:
             realoutfile.write(DOC_TEMPLATE %
@@ -249,6 +332,16 @@ class EnhancedLatexFormatter(LatexFormatter):
                      styledefs = self.get_style_defs(),
                      code      = outfile.getvalue()))
 
+    def format_lines(self, tokensource):
+        r"""
+        Return the lines of the highlighted tokens: the same that
+        ``format_unencoded`` writes inside the Verbatim environment but
+        without the environment (nor parsing it back).
+        """
+        out = []
+        self.format_tokens(tokensource, out.append)
+        return ''.join(out).split('\n')
+
 class LatexEmbeddedLexer(Lexer):
     r"""
 
@@ -260,6 +353,9 @@ class LatexEmbeddedLexer(Lexer):
     the resulting text is scanned for escaped segments, which are given
     the Token.Escape type. Finally text that is not escaped is scanned
     again with the language lexer.
+
+    The merged text is joined once and scanned for the delimiters from
+    left to right so long snippets with many escapes take linear time.
     """
     def __init__(self, left, right, lang, **options):
         self.left = left
@@ -268,38 +364,45 @@ class LatexEmbeddedLexer(Lexer):
         Lexer.__init__(self, **options)
 
     def get_tokens_unprocessed(self, text):
-        buf = ''
+        buf = []
         for i, t, v in self.lang.get_tokens_unprocessed(text):
             if t in Token.Comment or t in Token.String:
                 if buf:
-                    for x in self.get_tokens_aux(idx, buf):
+                    for x in self.get_tokens_aux(idx, ''.join(buf)):
                         yield x
-                    buf = ''
+                    buf = []
                 yield i, t, v
             else:
                 if not buf:
                     idx = i
-                buf += v
+                buf.append(v)
         if buf:
-            for x in self.get_tokens_aux(idx, buf):
+            for x in self.get_tokens_aux(idx, ''.join(buf)):
                 yield x
 
     def get_tokens_aux(self, index, text):
-        while text:
-            a, sep1, text = text.partition(self.left)
-            if a:
-                for i, t, v in self.lang.get_tokens_unprocessed(a):
-                    yield index + i, t, v
-                    index += len(a)
-            if sep1:
-                b, sep2, text = text.partition(self.right)
-                if sep2:
-                    yield index + len(sep1), Token.Escape, b
-                    index += len(sep1) + len(b) + len(sep2)
-                else:
-                    yield index, Token.Error, sep1
-                    index += len(sep1)
-                    text = b
+        left, right = self.left, self.right
+        closed = True
+        pos = 0
+        while pos < len(text):
+            end = text.find(left, pos)
+            if end < 0:
+                end = len(text)
+            if end > pos:
+                for i, t, v in self.lang.get_tokens_unprocessed(text[pos:end]):
+                    yield index + pos + i, t, v
+            if end == len(text):
+                break
+
+            pos = end + len(left)
+            # once a right delimiter is missing, there is none after it
+            close = text.find(right, pos) if closed else -1
+            if close >= 0:
+                yield index + pos, Token.Escape, text[pos:close]
+                pos = close + len(right)
+            else:
+                closed = False
+                yield index + end, Token.Error, left
 ###################################################
 
 GENERIC_DEFINITIONS_1 = r'''% -*- mode: latex -*-
@@ -341,125 +444,327 @@ DISPLAY_LINENOS_SNIPPET_TEMPLATE = r'''
 '''
 
 
-def pyg(outfile, outencoding, n, opts, extra_opts, text, usedstyles, inline_delim = ''):
-    try:
-        lexer = get_lexer_by_name(opts['lang'])
-    except ClassNotFound as err:
-        sys.stderr.write('Error: ')
-        sys.stderr.write(str(err))
-        return ""
+def snippet_key(opts, inline_delim, text):
+    r"""
+    Return a hash of everything that determines how a snippet is
+    highlighted: its options (including the language and style), if it
+    is inlined, its text and the versions of PygmenTeX and Pygments.
+    """
+    h = hashlib.sha256()
+    for part in (__version__, pygments.__version__, repr(inline_delim),
+                 repr(sorted(opts.items())), text):
+        h.update(part.encode('utf-8', 'surrogateescape'))
+        h.update(b'\0')
+    return h.hexdigest()
 
-    # global _fmter
-    _fmter = EnhancedLatexFormatter()
 
-    escapeinside = opts.get('escapeinside', '')
-    if len(escapeinside) == 2:
-        left = escapeinside[0]
-        right = escapeinside[1]
-        _fmter.escapeinside = escapeinside
-        _fmter.left = left
-        _fmter.right = right
-        lexer = LatexEmbeddedLexer(left, right, lexer)
+DEFAULT_CACHE_MAX_MB = 64
+
+class SnippetCache(object):
+    r"""
+    Persistent on-disk cache of highlighted snippets.
+
+    Each entry is stored in its own file named after the hash of the
+    snippet's options and text (see ``snippet_key``) so unchanged
+    snippets are served from here across runs and only new or edited
+    ones go through Pygments.
+
+    The same cache can be shared by several documents, even if they are
+    built at the same time: the entries are written atomically and only
+    one process evicts entries at a time. Each entry records the
+    ``origin`` (document) that highlighted it so the snippets reused
+    from other documents are counted apart.
 
+    The entries not used recently are evicted when the total size of
+    the cache exceeds ``max_size`` bytes.
+    """
+    def __init__(self, dirname, max_size, origin=''):
+        self.dirname = dirname
+        self.max_size = max_size
+        self.origin = origin
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        os.makedirs(dirname, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.dirname, key[:2], key)
+
+    def get(self, key):
+        entry = cache_util.read_entry(self._path(key))
+        parts = entry.split('\n', 2) if entry is not None else ()
+        if len(parts) != 3:
+            self.misses += 1
+            return None
+
+        origin, numbers, body = parts
+
+        self.hits += 1
+        if origin != self.origin:
+            self.shared_hits += 1
+        return numbers.split(',') if numbers else [], body
+
+    def put(self, key, numbers, body):
+        self._write(key, self.origin + '\n' + ','.join(numbers) + '\n' + body)
+
+    def get_style_defs(self, key):
+        r"""
+        Return the style definitions stored with ``key`` (see
+        ``style_defs_key``) or None. They are not counted as hits or
+        misses, these are for the snippets.
+        """
+        return cache_util.read_entry(self._path(key))
+
+    def put_style_defs(self, key, defs):
+        self._write(key, defs)
+
+    def _write(self, key, content):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        cache_util.write_entry(path, content)
+
+    def evict(self):
+        # if another process is evicting entries, leave it to it
+        with open(os.path.join(self.dirname, '.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return 0
+
+            return cache_util.evict(self.dirname, self.max_size)
+
+    def report(self, evicted=0):
+        return 'PygmenTeX cache: %d hits (%d from other documents), %d misses, %d evicted (%s)' % (
+                self.hits, self.shared_hits, self.misses, evicted, self.dirname)
+
+
+# Registry of the lexers and formatters already built, see get_lexer
+# and make_formatter. There are only a few combinations of language,
+# style and options across a document so there is no need to build
+# them (and their stylesheets) again for each snippet.
+_lexers = {}
+_formatters = {}
+
+def get_lexer(opts):
+    r"""
+    Return the lexer for the language and lexing options of a snippet
+    (escapeinside, gobble and tabsize), built once and reused later.
+
+    Raise ClassNotFound if the language is unknown.
+    """
+    lang = opts['lang']
+    escapeinside = opts.get('escapeinside', '')
+    if len(escapeinside) != 2:
+        escapeinside = ''
     gobble = abs(get_int_opt(opts, 'gobble', 0))
+    tabsize = abs(get_int_opt(opts, 'tabsize', 0))
+
+    key = (lang, escapeinside, gobble, tabsize)
+    lexer = _lexers.get(key)
+    if lexer is not None:
+        return lexer
+
+    lexer = get_lexer_by_name(lang)
+    if escapeinside:
+        lexer = LatexEmbeddedLexer(escapeinside[0], escapeinside[1], lexer)
+
     if gobble:
         lexer.add_filter('gobble', n=gobble)
 
-    tabsize = abs(get_int_opt(opts, 'tabsize', 0))
     if tabsize:
         lexer.tabsize = tabsize
 
     lexer.encoding = ''
-    # _fmter.encoding = outencoding
 
-    stylename = opts['sty']
+    _lexers[key] = lexer
+    return lexer
+
 
-    honorspacewidth = False
+def snippet_style(stylename):
+    r"""
+    Return the Pygments style for the style name of a snippet and if
+    the width of the spaces must be honored (see ``pyg``).
+
+    Raise ClassNotFound if the style is unknown.
+    """
     if stylename in ('candombe', 'candombefix', 'candombediagram', 'nostylediagram'):
-        _fmter.style = NoStyle if stylename == 'nostylediagram' else CandombeStyle
-        honorspacewidth = stylename in ('candombefix', 'candombediagram', 'nostylediagram')
-    else:
-        _fmter.style = get_style_by_name(stylename)
+        style = NoStyle if stylename == 'nostylediagram' else CandombeStyle
+        return style, stylename in ('candombefix', 'candombediagram', 'nostylediagram')
+
+    return get_style_by_name(stylename), False
+
 
+def make_formatter(opts):
+    r"""
+    Return the formatter for the style and escaping options of a snippet,
+    built once (with its stylesheet) and reused later.
+
+    Return the formatter and if the width of the spaces must be honored
+    (see ``pyg``).
+    """
+    stylename = opts['sty']
+    escapeinside = opts.get('escapeinside', '')
+    if len(escapeinside) != 2:
+        escapeinside = ''
+    texcomments = get_bool_opt(opts, 'texcomments', False)
+    mathescape = get_bool_opt(opts, 'mathescape', False)
+
+    key = (stylename, escapeinside, texcomments, mathescape)
+    cached = _formatters.get(key)
+    if cached is not None:
+        return cached
+
+    _fmter = EnhancedLatexFormatter()
+
+    if escapeinside:
+        _fmter.escapeinside = escapeinside
+        _fmter.left = escapeinside[0]
+        _fmter.right = escapeinside[1]
+
+    _fmter.style, honorspacewidth = snippet_style(stylename)
     _fmter._create_stylesheet()
 
-    _fmter.texcomments = get_bool_opt(opts, 'texcomments', False)
-    _fmter.mathescape = get_bool_opt(opts, 'mathescape', False)
-
-
-    if stylename not in usedstyles:
-        styledefs = _fmter.get_style_defs() \
-            .replace('#', '##') \
-            .replace(r'\##', r'\#') \
-            .replace(r'\makeatletter', '') \
-            .replace(r'\makeatother', '') \
-            .replace('\n', '%\n')
-        outfile.write(
-            '\\def\\PYstyle{0}{{%\n{1}%\n}}%\n'.format(stylename, styledefs))
-        usedstyles.append(stylename)
-
-    x = highlight(text, lexer, _fmter)
-
-    m = re.match(r'\\begin\{Verbatim}(.*)\n([\s\S]*?)\n\\end\{Verbatim}(\s*)\Z',
-                 x)
-    if m:
-        linenos = get_bool_opt(opts, 'linenos', False)
-        linenostart = abs(get_int_opt(opts, 'linenostart', 1))
-        linenostep = abs(get_int_opt(opts, 'linenostep', 1))
-        lines0 = m.group(2).split('\n')
-        numbers = []
-        lines = []
-        counter = linenostart
-        for line in lines0:
-            line = re.sub(r'^ ', r'\\makebox[0pt]{\\phantom{Xy}} ', line)
-            line = re.sub(r' ', '~', line)
-            if linenos:
-                if (counter - linenostart) % linenostep == 0:
-                    line = r'\pygmented@lineno@do{' + str(counter) + '}' + line
-                    numbers.append(str(counter))
-                counter = counter + 1
-            lines.append(line)
-        if inline_delim:
-            outfile.write(INLINE_SNIPPET_TEMPLATE %
-                dict(number    = n,
-                     style     = stylename,
-                     options   = extra_opts,
-                     body      = '\\newline\n'.join(lines)))
+    _fmter.texcomments = texcomments
+    _fmter.mathescape = mathescape
+
+    _formatters[key] = (_fmter, honorspacewidth)
+    return _fmter, honorspacewidth
+
+
+def style_defs_key(style):
+    r"""
+    Return a hash of everything that determines the definitions of a
+    style: the style class, its styles and the versions of PygmenTeX and
+    Pygments.
+    """
+    h = hashlib.sha256()
+    for part in ('style', __version__, pygments.__version__,
+                 style.__module__ + '.' + style.__qualname__,
+                 repr(sorted((str(ttype), value) for ttype, value in style.styles.items()))):
+        h.update(part.encode('utf-8', 'surrogateescape'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+# Definitions of the styles already generated, by style class, see
+# style_defs. The candombe styles share the definitions of CandombeStyle.
+_style_defs = {}
+
+def style_defs(stylename, cache = None):
+    r"""
+    Return the definition of the ``\PYstyle<stylename>`` macro with the
+    LaTeX definitions of the style.
+
+    The definitions of each style class are generated once and kept in
+    the ``cache``, if given, so later runs take them from there without
+    building a formatter for them.
+    """
+    style, _ = snippet_style(stylename)
+    styledefs = _style_defs.get(style)
+    if styledefs is None:
+        key = style_defs_key(style)
+        if cache is not None:
+            styledefs = cache.get_style_defs(key)
+        if styledefs is None:
+            styledefs = EnhancedLatexFormatter(style=style).get_style_defs() \
+                .replace('#', '##') \
+                .replace(r'\##', r'\#') \
+                .replace(r'\makeatletter', '') \
+                .replace(r'\makeatother', '') \
+                .replace('\n', '%\n')
+            if cache is not None:
+                cache.put_style_defs(key, styledefs)
+        _style_defs[style] = styledefs
+
+    return '\\def\\PYstyle{0}{{%\n{1}%\n}}%\n'.format(stylename, styledefs)
+
+
+def format_snippet(n, opts, extra_opts, numbers, body, inline_delim = ''):
+    if inline_delim:
+        return INLINE_SNIPPET_TEMPLATE % \
+            dict(number    = n,
+                 style     = opts['sty'],
+                 options   = extra_opts,
+                 body      = body)
+    else:
+        if get_bool_opt(opts, 'linenos', False):
+            template = DISPLAY_LINENOS_SNIPPET_TEMPLATE
         else:
-            if linenos:
-                template = DISPLAY_LINENOS_SNIPPET_TEMPLATE
-            else:
-                template = DISPLAY_SNIPPET_TEMPLATE
-
-            # The '~' is a special Latex character that means an
-            # unbreakable space and it is used by Pygments to type the
-            # spaces.
-            # Unfortunately the width of each space character is smaller
-            # than the size of the rest of the characters and while it
-            # is ok for normal source code, it is not ok when doing an
-            # ASCII diagram
-            #
-            # The fix is to replace all the ~ by a horizontal phantom
-            # space which width will be the same of the width of the
-            # given character (in this case a 'm').
-            #
-            # This should be safe even if the source code has a ~
-            # because Pygments will replace them with \PYZti{} before
-            # so we should be replacing only the ~ that represent
-            # spaces.
-            #
-            # https://github.com/pygments/pygments/blob/master/pygments/formatters/latex.py
-            # https://tex.stackexchange.com/questions/74353/what-commands-are-there-for-horizontal-spacing
-            if honorspacewidth:
-                lines = [l.replace('~',r'\hphantom{m}') for l in lines]
-
-            outfile.write(template %
-                dict(number      = n,
-                     style       = stylename,
-                     options     = extra_opts,
-                     linenosep   = opts['linenosep'],
-                     linenumbers = ','.join(numbers),
-                     body        = '\\newline\n'.join(lines)))
+            template = DISPLAY_SNIPPET_TEMPLATE
+
+        return template % \
+            dict(number      = n,
+                 style       = opts['sty'],
+                 options     = extra_opts,
+                 linenosep   = opts['linenosep'],
+                 linenumbers = ','.join(numbers),
+                 body        = body)
+
+
+def pyg(opts, text, inline_delim = ''):
+    r"""
+    Highlight the snippet ``text`` and return the line numbers to
+    show and its body, ready to be put in one of the snippet templates.
+
+    Return None if the snippet cannot be highlighted.
+    """
+    try:
+        lexer = get_lexer(opts)
+    except ClassNotFound as err:
+        sys.stderr.write('Error: ')
+        sys.stderr.write(str(err))
+        return None
+
+    _fmter, honorspacewidth = make_formatter(opts)
+
+    # The lexers end the text with a newline: it does not start a line
+    lines = _fmter.format_lines(lexer.get_tokens(text))
+    if lines.pop() != '':
+        return None
+
+    linenos = get_bool_opt(opts, 'linenos', False)
+    linenostart = abs(get_int_opt(opts, 'linenostart', 1))
+    linenostep = abs(get_int_opt(opts, 'linenostep', 1))
+    numbers = []
+    counter = linenostart
+    for i, line in enumerate(lines):
+        if line[:1] == ' ':
+            line = r'\makebox[0pt]{\phantom{Xy}}' + line
+        if linenos:
+            if (counter - linenostart) % linenostep == 0:
+                line = r'\pygmented@lineno@do{' + str(counter) + '}' + line
+                numbers.append(str(counter))
+            counter = counter + 1
+        lines[i] = line
+
+    # Pygments types the spaces with '~', a special Latex character that
+    # means an unbreakable space (a ~ in the source code is replaced by
+    # \PYZti{} so these are only spaces). A space at the begin of a line
+    # is preceded by an empty box of the height of a line (see above).
+    #
+    # Unfortunately the width of each space character is smaller
+    # than the size of the rest of the characters and while it
+    # is ok for normal source code, it is not ok when doing an
+    # ASCII diagram
+    #
+    # The fix is to type the spaces (and any other ~) as a horizontal
+    # phantom space which width will be the same of the width of the
+    # given character (in this case a 'm').
+    #
+    # Inlined snippets are never affected by this.
+    #
+    # https://github.com/pygments/pygments/blob/master/pygments/formatters/latex.py
+    # https://tex.stackexchange.com/questions/74353/what-commands-are-there-for-horizontal-spacing
+    #
+    # None of the prefixes added have spaces or ~ so they can be
+    # replaced in the whole body at once.
+    body = '\\newline\n'.join(lines)
+    if honorspacewidth and not inline_delim:
+        body = body.replace('~', r'\hphantom{m}').replace(' ', r'\hphantom{m}')
+    else:
+        body = body.replace(' ', '~')
+
+    return numbers, body
 
 
 
@@ -475,88 +780,296 @@ def parse_opts(basedic, opts):
 
 
 
-_re_display = re.compile(
-    r'^<@@pygmented@display@(\d+)\n(.*)\n([\s\S]*?)\n>@@pygmented@display@\1$',
-    re.MULTILINE)
+_SNIPPET_MARKER = '<@@pygmented@'
+_SNIPPET_KINDS = ('inline', 'display', 'input')
 
-_re_inline = re.compile(
-    r'^<@@pygmented@inline@(\d+)\n(.*)\n([\s\S]*?)\n>@@pygmented@inline@\1$',
-    re.MULTILINE)
+def _decode(data):
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return guess_decode(data)[0]
 
-_re_input = re.compile(
-    r'^<@@pygmented@input@(\d+)\n(.*)\n([\s\S]*?)\n>@@pygmented@input@\1$',
-    re.MULTILINE)
+def scan_snippets(code):
+    r"""
+    Scan ``code`` once and yield for each snippet found its kind
+    (inline, display or input), its number, its raw options and its
+    text.
 
-def convert(code, outfile, outencoding):
-    """
-    Convert ``code``
-    """
-    outfile.write(GENERIC_DEFINITIONS_1)
+    A snippet looks like:
 
-    opts = { 'lang'      : 'c',
-             'sty'       : 'default',
-             'linenosep' : '0pt',
-             'tabsize'   : '8',
-             'encoding'  : 'guess',
-           }
+        <@@pygmented@<kind>@<number>
+        <options>
+        <text>
+        >@@pygmented@<kind>@<number>
 
-    usedstyles = [ ]
-    styledefs = ''
+    where the text may span multiple lines (or none). Instead of
+    trying a regex per kind, the start marker is checked directly and
+    its end marker is searched for, so the text is never backtracked.
 
-    pos = 0
+    ``code`` can be a string or a bytes-like object like a ``mmap``:
+    in the latter case each snippet is decoded on its own so the file
+    is never loaded and decoded as a whole.
+    """
+    if isinstance(code, str):
+        enc, decode = (lambda s: s), (lambda s: s)
+    else:
+        enc, decode = str.encode, _decode
+
+    marker, nl, at, digits = enc(_SNIPPET_MARKER), enc('\n'), enc('@'), enc('0123456789')
+    end_markers = {enc(kind): (kind, enc('\n>@@pygmented@%s@' % kind))
+                   for kind in _SNIPPET_KINDS}
 
-    while pos < len(code):
-        if code[pos].isspace():
+    size = len(code)
+    pos = 0
+    while pos < size:
+        if code[pos:pos+1].isspace():
             pos = pos + 1
             continue
 
-        m = _re_inline.match(code, pos)
-        if m:
-            pyg(outfile,
-                outencoding,
-                m.group(1),
-                parse_opts(opts.copy(), m.group(2)),
-                '',
-                m.group(3),
-                usedstyles,
-                True)
-            pos = m.end()
-            continue
+        # a snippet must start at the begin of a line
+        if pos > 0 and code[pos-1:pos] != nl:
+            break
+
+        if code[pos:pos+len(marker)] != marker:
+            break
+
+        kind_begin = pos + len(marker)
+        kind_end = code.find(at, kind_begin, kind_begin + 8)
+        if kind_end < 0 or code[kind_begin:kind_end] not in end_markers:
+            break
+        kind, end_marker = end_markers[code[kind_begin:kind_end]]
+
+        num_end = code.find(nl, kind_end + 1)
+        number = code[kind_end + 1:num_end]
+        if num_end < 0 or not number or number.strip(digits):
+            break
+
+        opts_end = code.find(nl, num_end + 1)
+        if opts_end < 0:
+            break
+
+        # the text ends with the end marker of the same kind and number
+        # in its own line. The text may be empty but it has its own line
+        # anyways.
+        end_marker = end_marker + number
+        text_end = code.find(end_marker, opts_end + 1)
+        while text_end >= 0:
+            end = text_end + len(end_marker)
+            if end == size or code[end:end+1] == nl:
+                break
+            text_end = code.find(end_marker, text_end + 1)
+
+        if text_end < 0:
+            break
+
+        yield (kind, decode(number), decode(code[num_end + 1:opts_end]),
+               decode(code[opts_end + 1:text_end]))
+        pos = end
+
+    if pos < size:
+        sys.stderr.write('Error: invalid input file contents: ignoring')
 
-        m = _re_display.match(code, pos)
-        if m:
-            pyg(outfile,
-                outencoding,
-                m.group(1),
-                parse_opts(opts.copy(), m.group(2)),
-                '',
-                m.group(3),
-                usedstyles)
-            pos = m.end()
-            continue
 
-        m = _re_input.match(code, pos)
-        if m:
-            opts_new = parse_opts(opts, m.group(2))
+# Options of a snippet not given in the .snippets file
+DEFAULT_OPTS = { 'lang'      : 'c',
+                 'sty'       : 'default',
+                 'linenosep' : '0pt',
+                 'tabsize'   : '8',
+                 'encoding'  : 'guess',
+               }
+
+def parse_snippets(code):
+    r"""
+    Parse the snippets of ``code`` and yield for each the snippet
+    number, its options, its text and if it is an inlined snippet.
+
+    See ``scan_snippets`` for the accepted ``code``.
+    """
+    for kind, number, snippet_opts, text in scan_snippets(code):
+        if kind == 'inline':
+            yield number, parse_opts(DEFAULT_OPTS, snippet_opts), text, True
+
+        elif kind == 'display':
+            yield number, parse_opts(DEFAULT_OPTS, snippet_opts), text, ''
+
+        else:
+            opts_new = parse_opts(DEFAULT_OPTS, snippet_opts)
             try:
-                filecontents, inencoding = read_input(m.group(3), opts_new['encoding'])
+                filecontents, inencoding = read_input(text, opts_new['encoding'])
             except Exception as err:
                 print('Error: cannot read input file: ', err, file=sys.stderr)
             else:
-                pyg(outfile,
-                    outencoding,
-                    m.group(1),
-                    opts_new,
-                    "",
-                    filecontents,
-                    usedstyles)
-            pos = m.end()
+                yield number, opts_new, filecontents, ''
+
+
+def _pyg_job(args):
+    return pyg(*args)
+
+def highlight_snippets(snippets, keys, cache = None, jobs = 1):
+    r"""
+    Highlight the given ``snippets`` (see ``parse_snippets``) and
+    return the results of ``pyg`` in the same order.
+
+    The ``keys`` of the snippets (see ``snippet_key``) are used to
+    highlight only once the snippets that are identical and to look
+    them up in the ``cache``, if given: the snippets found there are not
+    highlighted again. The rest are highlighted in ``jobs`` processes if
+    it is greater than 1.
+    """
+    results = [None] * len(snippets)
+    missing = []
+    pending = {}
+    cached = {}
+    for i, key in enumerate(keys):
+        if key in pending:
+            # same snippet seen before in this run, reuse its result
+            pending[key].append(i)
             continue
 
-        sys.stderr.write('Error: invalid input file contents: ignoring')
-        break
+        if key in cached:
+            results[i] = cached[key]
+            continue
+
+        if cache is not None:
+            results[i] = cache.get(key)
+            if results[i] is not None:
+                cached[key] = results[i]
+                continue
+
+        pending[key] = [i]
+        missing.append(i)
+
+    args = [snippets[i][1:] for i in missing]
+    if jobs > 1 and len(args) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            chunksize = max(1, len(args) // (jobs * 4))
+            highlighted = pool.map(_pyg_job, args, chunksize=chunksize)
+            highlighted = list(highlighted)
+    else:
+        highlighted = map(_pyg_job, args)
+
+    for i, result in zip(missing, highlighted):
+        if cache is not None and result is not None:
+            cache.put(keys[i], *result)
+        for j in pending[keys[i]]:
+            results[j] = result
+
+    return results
+
+
+def convert(code, outfile, outencoding, cache = None, jobs = 1, base = None):
+    """
+    Convert ``code``
+
+    If a ``base`` is given (see ``load_base``), the definitions of the
+    snippets that did not change (same number and same key) are copied
+    from there as they are and only the rest are highlighted.
+
+    If a ``cache`` is given, the snippets are looked up there first
+    and only the missing ones are highlighted (and then stored).
+
+    If ``jobs`` is greater than 1, all the snippets are parsed first
+    and then highlighted in that many processes. They are written
+    in the original order in any case.
+
+    Return the manifest of the output: for each snippet number, its key
+    and where its definition is in the output (see ``write_manifest``).
+    """
+    snippets = list(parse_snippets(code))
+    keys = [snippet_key(opts, inline_delim, text)
+            for n, opts, text, inline_delim in snippets]
+
+    definitions = [None] * len(snippets)
+    if base:
+        for i, (n, opts, text, inline_delim) in enumerate(snippets):
+            key, definition = base.get(n, (None, None))
+            if key == keys[i]:
+                definitions[i] = definition
+
+    todo = [i for i, definition in enumerate(definitions) if definition is None]
+    results = highlight_snippets([snippets[i] for i in todo],
+                                 [keys[i] for i in todo], cache, jobs)
+
+    for i, result in zip(todo, results):
+        if result is not None:
+            n, opts, text, inline_delim = snippets[i]
+            numbers, body = result
+            definitions[i] = format_snippet(n, opts, '', numbers, body, inline_delim)
+
+    manifest = {}
+    offset = 0
+    def write(s):
+        nonlocal offset
+        outfile.write(s)
+        offset += len(s)
+
+    write(GENERIC_DEFINITIONS_1)
+
+    usedstyles = [ ]
+    for (n, opts, text, inline_delim), key, definition in zip(snippets, keys, definitions):
+        if definition is None:
+            continue
+
+        stylename = opts['sty']
+        if stylename not in usedstyles:
+            write(style_defs(stylename, cache))
+            usedstyles.append(stylename)
+
+        manifest[n] = (key, offset, len(definition))
+        write(definition)
+
+    write(GENERIC_DEFINITIONS_2)
+
+    return manifest
+
+
+def write_manifest(filename, manifest, snippets_sha256):
+    r"""
+    Write the ``manifest`` returned by ``convert`` as JSON into the
+    given file, next to the .pygmented file, so a later run can use the
+    .pygmented file as a base (see ``load_base``).
+
+    The SHA-256 of the .snippets file is recorded too so a script can
+    tell if the snippets changed without running PygmenTeX (see
+    pygmenter_xelatex.sh).
+    """
+    with open(filename, 'wt') as f:
+        json.dump(dict(version=__version__, snippets_sha256=snippets_sha256,
+                       snippets=manifest), f)
+
+
+def load_base(filename):
+    r"""
+    Load the .pygmented file ``filename`` written by a previous run and
+    its manifest (``filename`` + ``.manifest``) and return for each
+    snippet number its key and its definition.
+
+    Only the positions recorded in the manifest are checked, the file
+    is not parsed. If the manifest is missing or it does not match the
+    file, return an empty base.
+    """
+    try:
+        with open(filename + '.manifest', 'rt') as f:
+            manifest = json.load(f)
+        with open(filename, 'rt') as f:
+            pygmented = f.read()
+    except (OSError, ValueError):
+        return {}
+
+    if manifest.get('version') != __version__:
+        return {}
+
+    base = {}
+    for n, (key, offset, length) in manifest['snippets'].items():
+        definition = pygmented[offset:offset+length]
+        header = '\n\\expandafter\\def\\csname pygmented@snippet@%s\\endcsname' % n
+        if len(definition) != length or not definition.startswith(header):
+            return {}
+
+        base[n] = (key, definition)
+
+    return base
 
-    outfile.write(GENERIC_DEFINITIONS_2)
 
 def read_input(filename, encoding):
     with open(filename, 'rb') as infp:
@@ -569,9 +1082,21 @@ def read_input(filename, encoding):
 
     return code, encoding
 
+def map_input(filename):
+    r"""
+    Map the given file in memory and return it as a bytes-like object
+    so it can be scanned without reading it and decoding it as a whole
+    (see ``scan_snippets``).
+    """
+    with open(filename, 'rb') as infp:
+        if os.fstat(infp.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(infp.fileno(), 0, access=mmap.ACCESS_READ)
+
 
 USAGE = """\
-Usage: %s [-o <output file name>] <input file name>
+Usage: %s [-o <output file name>] [-b <base file name>] [-c <cache dir>]
+          [-j <jobs>] <input file name>
        %s -h | -V
 
 The input file should consist of a sequence of source code snippets, as
@@ -583,12 +1108,33 @@ It also writes to the output file a set of LaTeX macro definitions the
 Pygments styles that are used in the code snippets.
 
 If no output file name is given, use `<input file name>.pygmented`.
+A manifest of the output is written to `<output file name>.manifest`.
+
+The -b option takes the output of a previous run (and its manifest) as
+a base: the snippets that did not change are copied from there and only
+the new or changed ones are highlighted. The base can be the output
+file itself.
 
 The -e option enables escaping to LaTex. Text delimited by the <left>
 and <right> characters is read as LaTeX code and typeset accordingly. It
 has no effect in string literals. It has no effect in comments if
 `texcomments` or `mathescape` is set.
 
+The -c option enables a persistent cache of highlighted snippets in
+the given directory: snippets that did not change since a previous run
+(same text, options and style) are taken from there instead of being
+highlighted again. The definitions of the styles are kept there too.
+If not given, the PYGMENTEX_CACHE_DIR environment variable is used, if
+set. The same cache can be used by several documents at the same time,
+the snippets highlighted for one document are reused by the others. The cache is limited to PYGMENTEX_CACHE_MAX_MB
+megabytes (%d by default); the entries least recently used are evicted
+first.
+
+The -j option highlights the snippets in parallel using that many
+processes (0 means one per CPU). If not given, the PYGMENTEX_JOBS
+environment variable is used, if set, otherwise the snippets are
+highlighted one by one.
+
 The -h option prints this help.
 
 The -V option prints the package version.
@@ -599,10 +1145,10 @@ def main(args = sys.argv):
     """
     Main command line entry point.
     """
-    usage = USAGE % ((args[0],) * 2)
+    usage = USAGE % ((args[0],) * 2 + (DEFAULT_CACHE_MAX_MB,))
 
     try:
-        popts, args = getopt.getopt(args[1:], 'e:o:hV')
+        popts, args = getopt.getopt(args[1:], 'e:o:b:c:j:hV')
     except getopt.GetoptError as err:
         sys.stderr.write(usage)
         return 2
@@ -627,7 +1173,7 @@ def main(args = sys.argv):
         return 2
     infn = args[0]
     try:
-        code, inencoding = read_input(infn, "guess")
+        code = map_input(infn)
     except Exception as err:
         print('Error: cannot read input file: ', err, file=sys.stderr)
         return 1
@@ -636,13 +1182,57 @@ def main(args = sys.argv):
     if not outfn:
         root, ext = splitext(infn)
         outfn = root + '.pygmented'
+
+    # load the base before opening the output because it may be the
+    # same file
+    base = None
+    basefn = opts.pop('-b', None)
+    if basefn:
+        base = load_base(basefn)
+
     try:
         outfile = open(outfn, 'w')
     except Exception as err:
         print('Error: cannot open output file: ', err, file=sys.stderr)
         return 1
 
-    convert(code, outfile, inencoding)
+    cache = None
+    cachedir = opts.pop('-c', None) or os.getenv('PYGMENTEX_CACHE_DIR')
+    if cachedir:
+        max_mb = int(os.getenv('PYGMENTEX_CACHE_MAX_MB', DEFAULT_CACHE_MAX_MB))
+        try:
+            # identify the document by its snippets file, not by the
+            # output that may be written under any name (see -o)
+            origin = os.path.abspath(splitext(infn)[0])
+            cache = SnippetCache(cachedir, max_mb * 1024 * 1024, origin)
+        except Exception as err:
+            print('Warning: cannot use the cache, ignoring it: ', err, file=sys.stderr)
+
+    try:
+        jobs = int(opts.pop('-j', None) or os.getenv('PYGMENTEX_JOBS', 1))
+    except ValueError as err:
+        print('Error: invalid number of jobs: ', err, file=sys.stderr)
+        return 2
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+
+    manifest = convert(code, outfile, 'utf-8', cache, jobs, base)
+    outfile.close()
+
+    try:
+        write_manifest(outfn + '.manifest', manifest, hashlib.sha256(code).hexdigest())
+    except Exception as err:
+        print('Warning: cannot write the manifest: ', err, file=sys.stderr)
+
+    if base is not None:
+        reused = sum(1 for n, (key, _, _) in manifest.items()
+                     if base.get(n, (None,))[0] == key)
+        print('PygmenTeX base: %d of %d snippets reused (%s)' % (
+            reused, len(manifest), basefn))
+
+    if cache is not None:
+        evicted = cache.evict()
+        print(cache.report(evicted))
 
     return 0
 
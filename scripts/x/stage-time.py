@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# Run a command of a stage of the build and append to
+# out/stats/stages.jsonl (or STAGE_TIME_LOG) a JSON line with its wall
+# time, CPU time (user + system of the command and all its children)
+# and peak RSS (of the largest of them).
+#
+#   ./scripts/x/stage-time.py <stage> <target> <command> [<args>...]
+#
+# The rules of the Tupfile run their commands through this. Commands
+# timed inside another one (like xelatex and pygmentex inside the pdf
+# stage) are logged with that stage and its run as their parent.
+#
+# See scripts/stage-report.py for the report.
+
+import os, sys, json, time, resource, subprocess
+
+LOG = os.getenv('STAGE_TIME_LOG', 'out/stats/stages.jsonl')
+
+def main(argv=sys.argv):
+    if len(argv) < 4:
+        print("Usage: %s <stage> <target> <command> [<args>...]" % argv[0], file=sys.stderr)
+        return 1
+
+    stage, target, cmd = argv[1], argv[2], argv[3:]
+    parent = os.getenv('STAGE_TIME_PARENT')
+    parent_id = os.getenv('STAGE_TIME_PARENT_ID')
+    run_id = '%d-%d' % (os.getpid(), time.time_ns())
+
+    env = dict(os.environ, STAGE_TIME_PARENT=stage, STAGE_TIME_PARENT_ID=run_id)
+    begin = time.monotonic()
+    try:
+        status = subprocess.call(cmd, env=env)
+    except KeyboardInterrupt:
+        status = 130
+    wall = time.monotonic() - begin
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    record = {
+        'stage': stage,
+        'target': target,
+        'parent': parent,
+        'id': run_id,
+        'parent_id': parent_id,
+        'status': status,
+        'start': time.time() - wall,
+        'wall': wall,
+        'cpu': usage.ru_utime + usage.ru_stime,
+        'maxrss_kb': usage.ru_maxrss,
+        }
+
+    # a single write per line so the lines of the commands that run
+    # in parallel are not mixed
+    try:
+        os.makedirs(os.path.dirname(LOG), exist_ok=True)
+        with open(LOG, 'at') as f:
+            f.write(json.dumps(record) + '\n')
+    except OSError as err:
+        print("Cannot write the stage time log: %s" % err, file=sys.stderr)
+
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())